@@ -9,16 +9,14 @@ class EmailValidationForm(BaseDialog):
     title = "Email Validation"
     size = (400, 200)
 
-    def __init__(self, client, send_command, apply_command):
+    def __init__(self, client, send_command, apply_command, error=None):
         super(EmailValidationForm, self).__init__()
 
         self.client = client
         self.send_command = send_command
         self.apply_command = apply_command
 
-        self.code = "<not initialized>"
-
-        self.send_email()
+        self.code = None  # Hash of the code, unknown until an email was sent.
 
         self.label = QtWidgets.QLabel(f"Enter the code we sent to your email.", self)
         self.label.setStyleSheet(f"color: {colors['black']}")
@@ -46,20 +44,37 @@ class EmailValidationForm(BaseDialog):
                            regex="[0-9]*",
                            max_length=6)
 
+        if error:
+            # The previous code was refused, a new one is sent.
+            self.entry.show_error(error)
+
+        self.send_email()
+
         QtCore.QTimer.singleShot(10000, self.no_email)
 
     def typing(self):
-        if self.entry.encrypted == self.code:
+        # Without the hash (the email was not sent this time), the code is checked by the server.
+        if self.entry.encrypted == self.code or (self.code is None and len(self.entry.text()) == 6):
             if self.apply_command:
                 self.apply_command['parameters'] = self.apply_command.get('parameters', {})
                 self.apply_command['parameters'].update(code=self.entry.text())
-                self.client.send(self.apply_command)
+                # The code may have expired meanwhile, then the user asks for a new one.
+                if errors := self.client.execute(self.apply_command).get('errors'):
+                    self.entry.show_error(errors['code'])
+                    self.no_email()
+                    return
             self.result = self.entry.text()
         elif self.entry.text():
             self.entry.show_error("Wrong code")
 
     def send_email(self):
-        self.code = self.client.execute(self.send_command)
+        response = self.client.execute(self.send_command)
+        if response.startswith("ERROR:"):
+            # Too many emails, a code that was already sent is still valid.
+            self.entry.show_error(response.removeprefix("ERROR: "))
+            self.no_email()
+        else:
+            self.code = response
 
     def resend(self):
         self.resend_button.setEnabled(False)
@@ -43,7 +43,11 @@ class ForgotPassword(BaseDialog):
         self.submit_button.setEnabled(len(self.entry.text()) > 0)
 
     def reset_password(self):
-        if self.client.execute({"command": "username_exists", "parameters": {"username": self.entry.text()}}):
+        exists = self.client.execute({"command": "username_exists", "parameters": {"username": self.entry.text()}})
+        if isinstance(exists, str):
+            # Too many attempts.
+            self.entry.show_error(exists.removeprefix("ERROR: "))
+        elif exists:
             self.hide()
             self.reset_password_form = ResetPassword(self.client, self.entry.text())
             self.reset_password_form.exec_()
@@ -62,13 +66,8 @@ class ResetPassword(BaseDialog):
         self.client = client
         self.username = username
 
-        self.email_validation = EmailValidationForm(self.client,
-                                                    apply_command=None,
-                                                    send_command={'command': "send_validation_email",
-                                                                  'parameters': {'username': self.username}})
         self.hide()
-        self.email_validation.exec_()
-        self.code = self.email_validation.result
+        self.validate_email()
 
         self.password_entry = Entry(self,
                                     rect=(25, 100, 350, 40),
@@ -108,10 +107,24 @@ class ResetPassword(BaseDialog):
 
         errors = self.client.execute({'command': "reset_password", 'parameters': data})
 
-        if errors:
+        if 'code' in errors:
+            # The code expired, or was guessed too often, validating the email again with a new code.
+            self.hide()
+            self.validate_email(errors['code'])
+            self.show()
+        elif errors:
             for field, error in errors.items():
                 self.__dict__[f"{field}_entry"].show_error(error)
         else:
             self.hide()
 
             self.result = "ok"
+
+    def validate_email(self, error=None):
+        self.email_validation = EmailValidationForm(self.client,
+                                                    apply_command=None,
+                                                    send_command={'command': "send_validation_email",
+                                                                  'parameters': {'username': self.username}},
+                                                    error=error)
+        self.email_validation.exec_()
+        self.code = self.email_validation.result
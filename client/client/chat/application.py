@@ -175,6 +175,8 @@ class Chat(QtWidgets.QMainWindow):
         global USERNAME
         USERNAME = client.username
 
+        rooms, online = self.bootstrap()
+
         self.setWindowTitle("Chat Application")
         self.setFocusPolicy(QtCore.Qt.ClickFocus)
 
@@ -243,8 +245,10 @@ class Chat(QtWidgets.QMainWindow):
         self.online_label.setContentsMargins(0, 0, 50, 5)
 
         self.messages_by_room = {}
+        self.entered_rooms = set()  # Rooms whose recent messages were already shown.
+        self.show_backlog = False
 
-        self.rooms = {r: Room(r) for r in self.client.execute({'command': 'get_rooms'})}
+        self.rooms = {r: Room(r) for r in rooms}
 
         for room in self.rooms.keys():
             self.messages_by_room[room] = MessageList(self.chat_frame)
@@ -291,21 +295,44 @@ class Chat(QtWidgets.QMainWindow):
         self.resize(1200, 800)
         self.setMinimumSize(800, 600)
 
-        for c in self.client.execute({'command': "get_online"}):
+        for c in online:
             self.client_entered(c)
 
         self.messages_thread = Listener(self.client, self)
         self.messages_thread.msg_signal.connect(self.add_message)
+        self.messages_thread.backlog_signal.connect(self.add_backlog)
         self.messages_thread.entered_signal.connect(self.client_entered)
         self.messages_thread.start()
 
+    def bootstrap(self):
+        """
+        Get the rooms and the online users, in a single round trip when the server supports it.
+        """
+        commands = [{'command': "get_rooms"}, {'command': "get_online"}]
+
+        if "batch" not in self.client.features:
+            return [self.client.execute(command) for command in commands]
+
+        results = self.client.execute({'command': "batch", 'parameters': {'commands': commands}})
+        for result in results:
+            if 'error' in result:
+                raise Exception(result['error'])
+        return [result['data'] for result in results]
+
     def add_message(self, data):
         self.messages_by_room[self.current_room].add_message(text=data['message'],
                                                              author_name=data['name'], author_username=data['username'],
                                                              side=('left' if data['username'] == USERNAME else 'right'))
 
+    def add_backlog(self, data):
+        # The server sends the recent messages every time a room is entered, they are only shown the first time.
+        if self.show_backlog and data['room'] == self.current_room:
+            self.add_message(data)
+
     def enter_room(self, current: QtWidgets.QListWidgetItem, former):
         room_widget = self.rooms_list.itemWidget(current)
+        self.show_backlog = room_widget.name not in self.entered_rooms
+        self.entered_rooms.add(room_widget.name)
 
         if former is not None:
             self.rooms_list.itemWidget(former).name_label.setStyleSheet(f"color: {colors['black']};"
@@ -422,6 +449,7 @@ class Chat(QtWidgets.QMainWindow):
 class Listener(QtCore.QThread):
     msg_signal = QtCore.pyqtSignal(dict)
     entered_signal = QtCore.pyqtSignal(dict)
+    backlog_signal = QtCore.pyqtSignal(dict)
 
     def __init__(self, client, parent=None):
         super(Listener, self).__init__(parent)
@@ -439,3 +467,5 @@ class Listener(QtCore.QThread):
                 self.msg_signal.emit(r["data"])
             if r["type"] == "client_entered":
                 self.entered_signal.emit(r["data"])
+            if r["type"] == "backlog":
+                self.backlog_signal.emit(r["data"])
@@ -33,6 +33,8 @@ class Client(Socket):
 def main():
     with socket.create_connection((IP, PORT)) as client:
         client = Client(client)
+        # Switching to the newest protocol the server supports.
+        client.negotiate()
 
         app = QtWidgets.QApplication(sys.argv)
 
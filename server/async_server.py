@@ -0,0 +1,128 @@
+import asyncio
+import socket
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from client import Client
+from heartbeats import reaped, reaper
+from presence import Presence
+from requests_handler import RequestsHandler
+from smart_socket import RECEIVE_SIZE
+
+# Commands that wait for password hashes, they run on their own threads so that a login storm can't hold
+# every worker while other requests wait.
+HASHING_COMMANDS = {"login", "signup", "reset_password"}
+
+
+def hashes_passwords(request) -> bool:
+    if not isinstance(request, dict):
+        return False
+    if request.get('command') == "batch" and isinstance(parameters := request.get('parameters'), dict):
+        return any(isinstance(command, dict) and command.get('command') in HASHING_COMMANDS
+                   for command in parameters.get('commands', []))
+    return request.get('command') in HASHING_COMMANDS
+
+
+class AsyncClient(Client):
+    """
+    Client connected through asyncio streams instead of a blocking socket.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        super(AsyncClient, self).__init__(None)
+
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.outbox_event = asyncio.Event()
+
+        if peer := writer.get_extra_info("peername"):
+            self.address = peer[0]
+
+    def start_writer(self) -> None:
+        self.loop.create_task(self.write_loop())
+
+    async def write_loop(self) -> None:
+        while not self.closed:
+            await self.outbox_event.wait()
+            self.outbox_event.clear()
+
+            if frames := self.take():
+                data = b"".join(frames)
+                self.writer.write(data)
+                try:
+                    # Slow clients hold only their own writer, their queue fills up instead.
+                    await self.writer.drain()
+                except ConnectionError:
+                    self.close()
+                    return
+                metrics.outbound_bytes.inc(len(data))
+            self.written()
+
+    def wake(self) -> None:
+        # Commands run on worker threads, the transport must only be touched by the event loop.
+        self.loop.call_soon_threadsafe(self.outbox_event.set)
+
+    def close(self) -> None:
+        super(AsyncClient, self).close()
+        self.wake()
+
+    def disconnect(self) -> None:
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    async def receive_async(self):
+        while not self.frames:
+            data = await self.reader.read(RECEIVE_SIZE)
+            if not data:
+                raise ConnectionResetError("Connection closed by peer.")
+            self.feed(data)
+
+        return self.decode(self.unframe(*self.frames.popleft()))
+
+
+async def serve(sock: socket.socket, clients: Presence, workers: int) -> None:
+    """
+    Single-process event-loop server.
+    Sockets are owned by the event loop, commands run as coroutines on a bounded pool of worker threads,
+    so the number of threads no longer grows with the number of connections.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(workers, thread_name_prefix="handler")
+    hashing_executor = ThreadPoolExecutor(workers, thread_name_prefix="hashing_handler")
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = AsyncClient(reader, writer, loop)
+        metrics.connections.inc()
+        clients.add(client)
+        reaper.add(client, writer.get_extra_info("socket"))
+        handler = RequestsHandler(client, clients)
+        client.start_writer()
+
+        try:
+            while True:
+                try:
+                    request = await client.receive_async()
+                except TimeoutError:
+                    # TCP keepalive found that the peer is gone.
+                    reaped.inc(label="keepalive")
+                    break
+                except OSError:
+                    break
+
+                # Requests of a single client are still handled one after the other.
+                pool = hashing_executor if hashes_passwords(request) else executor
+                response = await loop.run_in_executor(pool, handler.handle, request)
+                if response is not None:
+                    client.send(response)
+        except Exception:
+            # The connection is dropped, the server keeps running.
+            traceback.print_exc()
+        finally:
+            await loop.run_in_executor(executor, handler.remove_client, client)
+            client.close()
+            writer.close()
+
+    server = await asyncio.start_server(handle_client, sock=sock)
+    async with server:
+        await server.serve_forever()
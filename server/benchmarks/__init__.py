@@ -0,0 +1,168 @@
+"""
+Server benchmarks.
+Run them from the server directory, for example:
+
+    python -m benchmarks.codecs --output codecs.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+import timeit
+from contextlib import contextmanager
+
+import migrations
+from passwords import hasher
+from rate_limit import limits
+from requests_handler import RequestsHandler
+from smart_socket import Socket
+
+IP = "127.0.0.1"
+PORT = 65433  # Not the default port, so that benchmarks can run next to a real server.
+DATABASE = RequestsHandler.database
+PASSWORD = "benchmark1"
+ROOMS = ("Sports", "Gaming", "Food")
+
+# Benchmarks measure the server's capacity, not its rate limits.
+limits.configure({})
+
+
+def parser(description: str) -> argparse.ArgumentParser:
+    result = argparse.ArgumentParser(description=description)
+    result.add_argument("--output", help="save the results as json to this file")
+    return result
+
+
+def measure(function, repeat: int = 5) -> float:
+    """
+    Best time of a single call to function, in seconds.
+    """
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def report(name: str, results: list[dict], output: str = None) -> None:
+    """
+    Print the results as a table and optionally save them in a machine-readable format.
+    """
+    columns = list(dict.fromkeys(key for result in results for key in result))
+    rows = [[format_value(result.get(column, "")) for column in columns] for result in results]
+    widths = [max(len(str(cell)) for cell in [column, *(row[i] for row in rows)]) for i, column in enumerate(columns)]
+
+    print(name)
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump({'benchmark': name, 'time': time.time(), 'commit': commit(), 'python': sys.version,
+                       'platform': platform.platform(), 'results': results}, file, indent=2)
+
+
+def commit() -> str:
+    """
+    The git commit the benchmark ran on, None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def scratch_database(directory: str, users: int, password: str = PASSWORD) -> tuple[str, list[str]]:
+    """
+    Copy of the server's database with active users, returns its path and the usernames.
+    """
+    path = os.path.join(directory, "database.db")
+    shutil.copy(DATABASE, path)
+    migrations.migrate(path)
+
+    usernames = [f"bench{i:06d}" for i in range(users)]
+    # All the users share the same salt, hashing once is enough.
+    encrypted_password = hasher.hash(password)
+    with sqlite3.connect(path) as db:
+        db.executemany("INSERT INTO tblUsers VALUES (?, ?, ?, ?, 1, ?)",
+                       [(username, "Bench User", f"{username}@bench.test", encrypted_password, "0501234567")
+                        for username in usernames])
+    return path, usernames
+
+
+@contextmanager
+def server(database: str, *arguments: str, port: int = PORT):
+    """
+    Run the server in a sub process for the duration of the context.
+    """
+    process = subprocess.Popen([sys.executable, "main.pyw", "--port", str(port), "--database", database,
+                                "--no-rate-limit", *arguments])
+    try:
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection((IP, port)).close()
+                break
+            except ConnectionRefusedError:
+                if time.time() > deadline or process.poll() is not None:
+                    raise
+                time.sleep(0.05)
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def rss(pid: int) -> int:
+    """
+    Resident memory of the process and all its descendants, in bytes. Linux only, 0 elsewhere.
+    """
+    if not os.path.isdir("/proc"):
+        return 0
+
+    children = {}
+    for entry in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                parent = int(file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    total = 0
+    processes = [pid]
+    while processes:
+        process = processes.pop()
+        processes.extend(children.get(process, ()))
+        try:
+            with open(f"/proc/{process}/statm") as file:
+                total += int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            pass
+    return total
+
+
+def connect(username: str, password: str = PASSWORD, room: str = None, port: int = PORT, **negotiation) -> Socket:
+    """
+    Headless client: connects, negotiates the protocol, logs in and optionally enters a room.
+    """
+    client = Socket(socket.create_connection((IP, port)))
+    client.negotiate(**negotiation)
+
+    response = client.execute({'command': "login", 'parameters': {'username': username, 'password': password}})
+    assert not response['errors'], response['errors']
+
+    if room is not None:
+        client.send({'command': "enter_room", 'parameters': {'room': room}})
+    return client
@@ -0,0 +1,41 @@
+"""
+Bytes on the wire and encode/decode time of every codec, for the real event shapes.
+"""
+from benchmarks import measure, parser, report
+from smart_socket import CODECS
+
+EVENTS = {
+    'message': {"type": "message", "data": {"message": "Hey, is anybody here?", "username": "johndoe",
+                                            "name": "John Doe"}},
+    'long_message': {"type": "message", "data": {"message": "Lorem ipsum dolor sit amet. " * 40,
+                                                 "username": "johndoe", "name": "John Doe"}},
+    'client_entered': {"type": "client_entered", "data": {"room": "Sports", "username": "johndoe"}},
+    'send_message': {"command": "send_message", "parameters": {"message": "Hey, is anybody here?"}},
+    'login': {"command": "login", "parameters": {"username": "johndoe", "password": "password123"}},
+    'login_response': {"errors": {}, "data": {"name": "John Doe"}},
+    'get_online': [{"room": room, "username": f"user{i}"} for i, room in
+                   zip(range(200), ["Sports", "Gaming", "Food"] * 100)],
+}
+
+
+def main():
+    args = parser(__doc__).parse_args()
+
+    results = []
+    for event, data in EVENTS.items():
+        for codec in CODECS.values():
+            payload = codec.encode(data)
+            assert codec.decode(payload) == data
+            results.append({
+                'event': event,
+                'codec': codec.name,
+                'bytes': len(payload),
+                'encode_us': measure(lambda: codec.encode(data)) * 1e6,
+                'decode_us': measure(lambda: codec.decode(payload)) * 1e6,
+            })
+
+    report("codecs", results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Bytes on the wire and compression CPU time for a stream of real events, for several compression thresholds.
+"""
+import random
+
+from benchmarks import parser, report
+from smart_socket import CODECS, FRAMED, Socket
+
+THRESHOLDS = (0, 256, 512, 1024, 4096, None)  # None - no compression.
+
+
+def events(count: int) -> list:
+    """
+    Chat messages of various lengths mixed with presence events and get_online responses.
+    """
+    rng = random.Random(0)
+    words = "hey hello what is up the game was great did you see it dinner tonight pizza or sushi".split()
+    result = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.7:
+            message = " ".join(rng.choice(words) for _ in range(int(rng.expovariate(1 / 30)) + 1))
+            result.append({"type": "message", "data": {"message": message, "username": f"user{rng.randrange(500)}",
+                                                       "name": "John Doe"}})
+        elif kind < 0.95:
+            result.append({"type": "client_entered", "data": {"room": rng.choice(["Sports", "Gaming", "Food"]),
+                                                              "username": f"user{rng.randrange(500)}"}})
+        else:
+            result.append([{"room": rng.choice(["Sports", "Gaming", "Food"]), "username": f"user{j}"}
+                           for j in range(rng.randrange(10, 500))])
+    return result
+
+
+def main():
+    arguments = parser(__doc__)
+    arguments.add_argument("--events", type=int, default=5000)
+    arguments.add_argument("--codec", choices=list(CODECS), default="json")
+    args = arguments.parse_args()
+
+    payloads = [CODECS[args.codec].encode(event) for event in events(args.events)]
+    raw_bytes = sum(len(payload) for payload in payloads)
+
+    results = []
+    for threshold in THRESHOLDS:
+        sender, receiver = Socket(None), Socket(None)
+        for side in (sender, receiver):
+            side.upgrade(FRAMED, args.codec, None if threshold is None else "zlib")
+            side.compression_threshold = threshold
+
+        wire_bytes = 0
+        for payload in payloads:
+            frame = sender.frame(payload)
+            wire_bytes += len(frame)
+            receiver.feed(frame)
+            assert receiver.unframe(*receiver.frames.popleft()) == payload
+
+        stats = sender.compression_stats
+        results.append({
+            'threshold': "off" if threshold is None else threshold,
+            'raw_bytes': raw_bytes,
+            'wire_bytes': wire_bytes,
+            'saved': 1 - wire_bytes / raw_bytes,
+            'compressed_frames': stats.frames,
+            'ratio': stats.ratio,
+            'compress_us_per_frame': stats.compress_time / stats.frames * 1e6 if stats.frames else 0.0,
+            'decompress_us_per_frame': (receiver.compression_stats.decompress_time / stats.frames * 1e6
+                                        if stats.frames else 0.0),
+        })
+
+    report("compression", results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Concurrent signup and login throughput of RequestsHandler, with a SQLite connection per handler and no user cache
+(before) and with the shared QueryExecutor and UserCache (after).
+"""
+import sqlite3
+import tempfile
+import threading
+import time
+
+import requests_handler
+import utils
+from benchmarks import PASSWORD, parser, report, scratch_database
+from client import Client
+from passwords import PasswordHasher
+from presence import Presence
+from requests_handler import RequestsHandler
+from user_cache import UserCache
+from utils import QueryExecutor
+
+# Modules which get their executor from QueryExecutor.shared(), utils for every PerDatabase component.
+EXECUTOR_USERS = (requests_handler, utils)
+
+
+class PerConnection:
+    """
+    The executor every handler used to open for itself.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+
+    @classmethod
+    def shared(cls, path: str) -> "PerConnection":
+        # Not shared at all, a new connection for every handler.
+        return cls(path)
+
+    def __call__(self, query: str, parameters: list) -> list:
+        result = list(self.db.execute(query, parameters))
+        self.db.commit()
+        return result
+
+
+class Uncached(UserCache):
+    """
+    Nothing is kept, every lookup queries the database as the handlers used to.
+    """
+    max_size = 0
+
+
+def run(database: str, executor, users, handlers: int, operations: int) -> float:
+    """
+    Every handler signs up and logs in its own users, returns operations per second.
+    """
+    presence = Presence()
+    RequestsHandler.database = database
+    # The message log, outbox and code store open their executor too, they must not switch the database to WAL.
+    for module in EXECUTOR_USERS:
+        module.QueryExecutor = executor
+    requests_handler.UserCache = users
+
+    def work(worker: int):
+        for i in range(operations // 2):
+            handler = RequestsHandler(Client(None), presence)
+
+            username = f"user{worker}x{i}"
+            errors = handler.signup(username=username, password=PASSWORD, password_confirmation=PASSWORD,
+                                    name="Benchmark User", email=f"{username}@bench.test", phone_number="0501234567")
+            assert not errors, errors
+            handler.login(username="bench000000", password=PASSWORD)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(handlers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return handlers * (operations // 2) * 2 / (time.perf_counter() - start)
+
+
+def main():
+    arguments = parser(__doc__)
+    arguments.add_argument("--handlers", type=int, nargs="+", default=[1, 4, 16, 64])
+    arguments.add_argument("--operations", type=int, default=100, help="signups and logins per handler")
+    arguments.add_argument("--hash-cost", type=int, default=1000,
+                           help="PBKDF2 iterations, low so that the database dominates (see benchmarks.passwords)")
+    args = arguments.parse_args()
+
+    PasswordHasher.iterations = args.hash_cost
+
+    results = []
+    for handlers in args.handlers:
+        for name, executor, users in (("per_connection", PerConnection, Uncached),
+                                      ("shared", QueryExecutor, UserCache)):
+            with tempfile.TemporaryDirectory() as directory:
+                database, _ = scratch_database(directory, 1)
+                if executor is PerConnection:
+                    with sqlite3.connect(database) as db:
+                        db.execute("PRAGMA journal_mode=DELETE")
+                results.append({'executor': name, 'handlers': handlers,
+                                'operations_per_second': run(database, executor, users, handlers, args.operations)})
+                for instances in (QueryExecutor.instances, users.instances):
+                    instances.pop(database, None)
+
+    report("database", results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Headless load test: users spread over the rooms send messages at a target rate,
+reports the end-to-end fan-out latency, the delivered messages per second and the server's memory.
+Every server mode given is measured on its own scratch database.
+"""
+import multiprocessing
+import shlex
+import statistics
+import tempfile
+import threading
+import time
+
+from benchmarks import ROOMS, connect, parser, report, rss, scratch_database, server
+from passwords import PasswordHasher
+
+
+def load(usernames: list[str], rate: float, start: float, duration: float, results) -> None:
+    """
+    Runs in a client process: one receiver thread per user, and a single sender pacing the process's share of the rate.
+    Messages carry their sending time, time.monotonic() is shared by all the processes of the machine.
+    """
+    clients = [connect(username, room=ROOMS[i % len(ROOMS)]) for i, username in enumerate(usernames)]
+    latencies = [[] for _ in clients]
+    sent = 0
+
+    def send():
+        nonlocal sent
+        # Sending on a fixed schedule, so that a slow send does not lower the rate.
+        while (now := time.monotonic()) < start + duration:
+            if (delay := start + sent / rate - now) > 0:
+                time.sleep(delay)
+            clients[sent % len(clients)].send({'command': "send_message",
+                                               'parameters': {'message': f"{time.monotonic()} load"}})
+            sent += 1
+
+    def receive(i):
+        clients[i].socket.settimeout(duration + 10)
+        while True:
+            try:
+                event = clients[i].receive()
+            except OSError:
+                return
+            if event.get('type') == "message":
+                received = time.monotonic()
+                sent_at = float(event['data']['message'].split()[0])
+                if start <= sent_at < start + duration:
+                    latencies[i].append(received - sent_at)
+
+    for i in range(len(clients)):
+        threading.Thread(target=receive, args=(i,), daemon=True).start()
+    time.sleep(max(start - time.monotonic(), 0))
+    send()
+    # Waiting for the last messages to arrive.
+    time.sleep(1)
+
+    results.put((sent, [latency for client in latencies for latency in client]))
+    for client in clients:
+        client.socket.close()
+
+
+def percentile(values: list[float], p: int) -> float:
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else (values or [0])[0]
+
+
+def run(database: str, usernames: list[str], args, mode: str) -> dict:
+    context = multiprocessing.get_context("fork")
+    arguments = ["--mode", mode, "--processes", str(args.processes), "--hash-cost", str(args.hash_cost),
+                 *shlex.split(args.server_args)]
+
+    with server(database, *arguments) as process:
+        idle_rss = rss(process.pid)
+
+        queue = context.Queue()
+        start = time.monotonic() + 2 + len(usernames) * 0.01
+        share = args.rate / args.client_processes
+        loaders = [context.Process(target=load, args=(usernames[i::args.client_processes], share, start,
+                                                      args.duration, queue))
+                   for i in range(args.client_processes)]
+        for loader in loaders:
+            loader.start()
+
+        # Sampling the server's memory while the load runs.
+        peak_rss = idle_rss
+        while time.monotonic() < start + args.duration:
+            peak_rss = max(peak_rss, rss(process.pid))
+            time.sleep(0.2)
+
+        totals = [queue.get() for _ in loaders]
+        for loader in loaders:
+            loader.join()
+
+    sent = sum(total[0] for total in totals)
+    latencies = [latency for total in totals for latency in total[1]]
+    return {'mode': mode, 'processes': args.processes, 'users': len(usernames), 'target_rate': args.rate,
+            'sent_per_second': sent / args.duration, 'delivered_per_second': len(latencies) / args.duration,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000, 'idle_rss_mb': idle_rss / 2 ** 20,
+            'peak_rss_mb': peak_rss / 2 ** 20}
+
+
+def main():
+    arguments = parser(__doc__)
+    arguments.add_argument("--users", type=int, default=60)
+    arguments.add_argument("--rate", type=float, default=100, help="messages per second sent by all the users")
+    arguments.add_argument("--duration", type=float, default=10)
+    arguments.add_argument("--modes", nargs="+", choices=["threaded", "async"], default=["threaded", "async"])
+    arguments.add_argument("--processes", type=int, default=1, help="server processes")
+    arguments.add_argument("--client-processes", type=int, default=2)
+    arguments.add_argument("--hash-cost", type=int, default=1000, help="PBKDF2 iterations, so logging in is quick")
+    arguments.add_argument("--server-args", default="",
+                           help='more arguments of the server, e.g. --server-args="--overflow coalesce"')
+    args = arguments.parse_args()
+
+    PasswordHasher.iterations = args.hash_cost
+    results = []
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as directory:
+            database, usernames = scratch_database(directory, args.users)
+            results.append(run(database, usernames, args, mode))
+
+    report("load", results, args.output)
+
+
+if __name__ == '__main__':
+    main()
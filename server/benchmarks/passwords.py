@@ -0,0 +1,70 @@
+"""
+Concurrent logins per second of RequestsHandler at several password hashing costs.
+"""
+import tempfile
+import threading
+import time
+
+from benchmarks import PASSWORD, measure, parser, report, scratch_database
+from client import Client
+from passwords import PasswordHasher, hasher
+from presence import Presence
+from requests_handler import RequestsHandler
+from user_cache import UserCache
+from utils import QueryExecutor
+
+
+def run(database: str, usernames: list[str], duration: float) -> float:
+    """
+    Every user logs in and out repeatedly on its own thread, returns logins per second.
+    """
+    presence = Presence()
+    RequestsHandler.database = database
+    logins = [0] * len(usernames)
+    deadline = time.perf_counter() + duration
+
+    def work(i: int):
+        while time.perf_counter() < deadline:
+            client = Client(None)
+            presence.add(client)
+            result = RequestsHandler(client, presence).login(username=usernames[i], password=PASSWORD)
+            assert not result['errors'], result
+            presence.remove(client)
+            logins[i] += 1
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(len(usernames))]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(logins) / (time.perf_counter() - start)
+
+
+def main():
+    arguments = parser(__doc__)
+    arguments.add_argument("--costs", type=int, nargs="+", default=[1000, 10000, 100000, PasswordHasher.iterations],
+                           help="PBKDF2 iterations")
+    arguments.add_argument("--workers", type=int, default=PasswordHasher.workers, help="hashing threads")
+    arguments.add_argument("--clients", type=int, default=16, help="users logging in at the same time")
+    arguments.add_argument("--duration", type=float, default=3)
+    args = arguments.parse_args()
+
+    PasswordHasher.workers = args.workers
+    salt = hasher.salt()
+    results = []
+    for cost in args.costs:
+        PasswordHasher.iterations = cost
+        with tempfile.TemporaryDirectory() as directory:
+            database, usernames = scratch_database(directory, args.clients)
+            results.append({'iterations': cost, 'workers': args.workers, 'clients': args.clients,
+                            'logins_per_second': run(database, usernames, args.duration),
+                            'hash_ms': measure(lambda: hasher.compute(PASSWORD, salt, cost), repeat=3) * 1000})
+            QueryExecutor.instances.pop(database, None)
+            UserCache.instances.pop(database, None)
+
+    report("passwords", results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Messages per second delivered by the server with 1 to N worker processes.
+Clients are spread over the rooms, every client sends messages as fast as it can and counts the messages it gets.
+"""
+import multiprocessing
+import tempfile
+import threading
+import time
+
+from benchmarks import ROOMS, connect, parser, report, scratch_database, server
+
+
+def load(usernames: list[str], start: float, duration: float, results) -> None:
+    """
+    Runs in a client process, one sender and one receiver thread per user.
+    """
+    clients = [connect(username, room=ROOMS[i % len(ROOMS)]) for i, username in enumerate(usernames)]
+    sent = [0] * len(clients)
+    received = [0] * len(clients)
+
+    def send(i):
+        time.sleep(max(start - time.time(), 0))
+        while time.time() < start + duration:
+            clients[i].send({'command': "send_message", 'parameters': {'message': f"{time.time()} benchmark"}})
+            sent[i] += 1
+
+    def receive(i):
+        clients[i].socket.settimeout(duration + 10)
+        while True:
+            try:
+                event = clients[i].receive()
+            except OSError:
+                return
+            if event.get('type') == "message" and start <= time.time() < start + duration:
+                received[i] += 1
+
+    threads = [threading.Thread(target=target, args=(i,), daemon=True)
+               for i in range(len(clients)) for target in (send, receive)]
+    for thread in threads:
+        thread.start()
+    time.sleep(max(start + duration - time.time(), 0) + 0.5)
+
+    results.put((sum(sent), sum(received)))
+    for client in clients:
+        client.socket.close()
+
+
+def main():
+    arguments = parser(__doc__)
+    arguments.add_argument("--processes", type=int, default=multiprocessing.cpu_count(),
+                           help="benchmark 1 to this many server processes")
+    arguments.add_argument("--clients", type=int, default=60)
+    arguments.add_argument("--client-processes", type=int, default=4)
+    arguments.add_argument("--duration", type=float, default=5)
+    arguments.add_argument("--mode", choices=["threaded", "async"], default="threaded")
+    args = arguments.parse_args()
+
+    context = multiprocessing.get_context("fork")
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        database, usernames = scratch_database(directory, args.clients)
+
+        for processes in range(1, args.processes + 1):
+            with server(database, "--mode", args.mode, "--processes", str(processes)):
+                queue = context.Queue()
+                start = time.time() + 2 + args.clients * 0.01
+                loaders = [context.Process(target=load, args=(usernames[i::args.client_processes], start,
+                                                              args.duration, queue))
+                           for i in range(args.client_processes)]
+                for loader in loaders:
+                    loader.start()
+                totals = [queue.get() for _ in loaders]
+                for loader in loaders:
+                    loader.join()
+
+            sent = sum(total[0] for total in totals)
+            received = sum(total[1] for total in totals)
+            results.append({'processes': processes, 'clients': args.clients, 'sent_per_second': sent / args.duration,
+                            'delivered_per_second': received / args.duration})
+
+    report("sharding", results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Microbenchmarks of the per-message path, for a range of payload sizes:
+Socket.send + receive over a socketpair, JSON encoding of the real events, RequestsHandler.handle dispatch
+and encrypt().
+"""
+import socket
+import tempfile
+
+from benchmarks import measure, parser, report, scratch_database
+from client import Client
+from presence import Presence
+from requests_handler import RequestsHandler
+from smart_socket import FRAMED, JsonCodec, Socket
+from utils import encrypt
+
+SIZES = (16, 256, 4096, 65536)  # Bytes of message text, the largest fits in a socketpair's buffer.
+
+
+def message(size: int) -> dict:
+    return {"type": "message", "data": {"message": "x" * size, "username": "johndoe", "name": "John Doe"}}
+
+
+def socket_pairs():
+    """
+    Connected (sender, receiver) Sockets, for every framing a client may negotiate.
+    """
+    for name, version, codec, compression in (("legacy", None, None, None), ("framed_json", FRAMED, "json", None),
+                                              ("framed_compact", FRAMED, "compact", None),
+                                              ("framed_zlib", FRAMED, "json", "zlib")):
+        left, right = socket.socketpair()
+        sender, receiver = Socket(left), Socket(right)
+        if version is not None:
+            sender.upgrade(version, codec, compression)
+            receiver.upgrade(version, codec, compression)
+        yield name, sender, receiver
+
+
+def send_receive(sizes: tuple[int]) -> list[dict]:
+    results = []
+    for name, sender, receiver in socket_pairs():
+        for size in sizes:
+            data = message(size)
+
+            def round_trip():
+                sender.send(data)
+                receiver.receive()
+
+            results.append({'benchmark': "send_receive", 'case': name, 'bytes': size,
+                            'us': measure(round_trip) * 1e6})
+        sender.socket.close()
+        receiver.socket.close()
+    return results
+
+
+def json_events(sizes: tuple[int]) -> list[dict]:
+    results = []
+    shapes = {'message': message, 'get_online': lambda size: [{"room": "Sports", "username": f"user{i}"}
+                                                               for i in range(max(size // 40, 1))]}
+    for name, shape in shapes.items():
+        for size in sizes:
+            data = shape(size)
+            payload = JsonCodec.encode(data)
+            results.append({'benchmark': "json_encode", 'case': name, 'bytes': len(payload),
+                            'us': measure(lambda: JsonCodec.encode(data)) * 1e6})
+            results.append({'benchmark': "json_decode", 'case': name, 'bytes': len(payload),
+                            'us': measure(lambda: JsonCodec.decode(payload)) * 1e6})
+    return results
+
+
+def dispatch(sizes: tuple[int]) -> list[dict]:
+    """
+    Cost of RequestsHandler.handle on top of calling the command itself.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        RequestsHandler.database, _ = scratch_database(directory, 0)
+        presence = Presence()
+        client = Client(None)
+        presence.add(client)
+        presence.login(client, "johndoe", "John Doe")
+        presence.enter_room(client, "Sports")
+        handler = RequestsHandler(client, presence)
+
+        results.append({'benchmark': "dispatch", 'case': "get_rooms_direct",
+                        'us': measure(handler.get_rooms) * 1e6})
+        for case, request in (("get_rooms", {'command': "get_rooms"}),
+                              ("get_rooms_with_id", {'command': "get_rooms", 'id': 1}),
+                              ("unknown_command", {'command': "unknown"})):
+            results.append({'benchmark': "dispatch", 'case': case,
+                            'us': measure(lambda: handler.handle(request)) * 1e6})
+
+        for size in sizes:
+            request = {'command': "send_message", 'parameters': {'message': "x" * size}}
+            results.append({'benchmark': "dispatch", 'case': "send_message", 'bytes': size,
+                            'us': measure(lambda: handler.handle(request)) * 1e6})
+        handler.messages.flush()
+    return results
+
+
+def encryption(sizes: tuple[int]) -> list[dict]:
+    results = []
+    for size in sizes:
+        text = "x" * size
+        results.append({'benchmark': "encrypt", 'bytes': size, 'us': measure(lambda: encrypt(text)) * 1e6})
+    return results
+
+
+def main():
+    arguments = parser(__doc__)
+    arguments.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="bytes of message text")
+    arguments.add_argument("--only", choices=["send_receive", "json", "dispatch", "encrypt"],
+                           help="run a single group of benchmarks")
+    args = arguments.parse_args()
+
+    groups = {'send_receive': send_receive, 'json': json_events, 'dispatch': dispatch, 'encrypt': encryption}
+    results = []
+    for name, group in groups.items():
+        if args.only in (None, name):
+            results += group(tuple(args.sizes))
+
+    report("wire", results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,55 @@
+import socket
+import time
+from _thread import start_new_thread
+from collections import deque
+from threading import Condition
+
+import metrics
 from smart_socket import Socket
+from tracing import tracer
+
+# What to do when a client's outbound queue is full:
+DROP_OLDEST = "drop_oldest"  # Drop the oldest queued event.
+DISCONNECT = "disconnect"  # Disconnect the client, it is too slow to follow the chat.
+COALESCE = "coalesce"  # Replace a queued event with the same key (e.g. the presence of the same user).
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT, COALESCE)
 
 
 class Client(Socket):
+    max_queue = 1000  # Outbound events that may wait for a client.
+    overflow_policy = DROP_OLDEST
+
     def __init__(self, sock):
         super(Client, self).__init__(sock)
 
+        # Address of the peer, None when unknown.
+        try:
+            self.address = sock.getpeername()[0]
+        except (AttributeError, OSError):
+            self.address = None
+
         self.room = None
         self._username = None
         self.name = None
 
+        # Events waiting to be written by the writer, as (key, payload, framed) tuples.
+        self.outbox = deque()
+        self.outbox_changed = Condition()
+        self.writing = False
+        self.closed = False
+
+        # Queue metrics.
+        self.max_depth = 0
+        self.dropped = 0
+
+        # Heartbeats: when the client was last heard from, and when it was pinged (None when it answered).
+        self.last_seen = time.monotonic()
+        self.pinged_at = None
+
+        # When tracing: when the first bytes of the next request arrived, and the trace of the received request.
+        self.receiving = None
+        self.trace = None
+
     @property
     def is_authenticated(self):
         return self.username is not None
@@ -22,3 +63,169 @@ class Client(Socket):
         if self.is_authenticated:
             raise Exception("Client is already authenticated.")
         self._username = value
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.outbox)
+
+    def queue_stats(self) -> dict:
+        return {'username': self.username, 'depth': self.queue_depth, 'max_depth': self.max_depth,
+                'dropped': self.dropped}
+
+    def feed(self, data) -> None:
+        self.last_seen = time.monotonic()
+        if tracer.enabled and self.receiving is None:
+            self.receiving = time.perf_counter()
+        super(Client, self).feed(data)
+
+    def decode(self, payload: bytes):
+        if self.receiving is None:
+            return super(Client, self).decode(payload)
+
+        received, start = self.receiving, time.perf_counter()
+        request = super(Client, self).decode(payload)
+        # More requests may have arrived with this one.
+        self.receiving = start if self.frames else None
+
+        if (trace := tracer.begin(received)) is not None:
+            trace.username = self.username
+            trace.add("receive", received, start, bytes=len(payload))
+            trace.add("decode", start, time.perf_counter())
+        self.trace = trace
+        return request
+
+    def send(self, data, key=None) -> None:
+        """
+        Queue data for the writer, never blocks.
+        key identifies events that may replace each other when the coalesce policy is used.
+        """
+        self.enqueue(self.encode(data), key)
+
+    def enqueue(self, payload: bytes, key=None, framed: bool = False) -> None:
+        with self.outbox_changed:
+            if self.closed:
+                return
+
+            if len(self.outbox) >= self.max_queue and not self.overflow(key):
+                return
+
+            self.outbox.append((key, payload, framed))
+            self.max_depth = max(self.max_depth, len(self.outbox))
+            self.outbox_changed.notify_all()
+        self.wake()
+
+    def overflow(self, key) -> bool:
+        """
+        Make room in a full queue, returns whether the new event should still be queued.
+        Must be called while holding outbox_changed.
+        """
+        self.dropped += 1
+
+        if self.overflow_policy == DISCONNECT:
+            self.closed = True
+            self.outbox.clear()
+            self.disconnect()
+            return False
+
+        if self.overflow_policy == COALESCE and key is not None:
+            # Replacing an older event with the same key, otherwise the oldest event is dropped.
+            for i, (queued_key, _, _) in enumerate(self.outbox):
+                if queued_key == key:
+                    del self.outbox[i]
+                    return True
+
+        self.outbox.popleft()
+        return True
+
+    def take(self) -> list[bytes]:
+        """
+        Remove all the queued payloads, framed and ready to be written.
+        """
+        with self.outbox_changed:
+            batch, self.outbox = self.outbox, deque()
+            self.writing = bool(batch)
+
+        return [payload if framed else self.frame(payload) for _, payload, framed in batch]
+
+    def written(self) -> None:
+        with self.outbox_changed:
+            self.writing = False
+            self.outbox_changed.notify_all()
+
+    def flush(self) -> None:
+        """
+        Wait until everything that was queued so far is written.
+        """
+        with self.outbox_changed:
+            while (self.outbox or self.writing) and not self.closed:
+                self.outbox_changed.wait()
+
+    def start_writer(self) -> None:
+        start_new_thread(self.write_loop, ())
+
+    def write_loop(self) -> None:
+        while True:
+            with self.outbox_changed:
+                while not self.outbox and not self.closed:
+                    self.outbox_changed.wait()
+                if self.closed:
+                    return
+
+            data = b"".join(self.take())
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                self.close()
+                return
+            metrics.outbound_bytes.inc(len(data))
+            self.written()
+
+    def wake(self) -> None:
+        # The writer thread waits on outbox_changed which was already notified.
+        pass
+
+    def close(self) -> None:
+        with self.outbox_changed:
+            self.closed = True
+            self.outbox.clear()
+            self.outbox_changed.notify_all()
+
+    def compresses(self, payload: bytes) -> bool:
+        return self.compressor is not None and len(payload) >= self.compression_threshold
+
+    def disconnect(self) -> None:
+        # The receiving thread gets an error and removes the client.
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def lagging_clients(clients: list[Client], min_depth: int = 1) -> list[dict]:
+    """
+    Queue metrics of the clients that have at least min_depth events waiting, the slowest first.
+    """
+    stats = [client.queue_stats() for client in list(clients) if client.queue_depth >= min_depth]
+    return sorted(stats, key=lambda s: s['depth'], reverse=True)
+
+
+def broadcast(clients: list[Client], data, key=None) -> None:
+    """
+    Send the same event to many clients.
+    The event is encoded once per codec and framed once per framing, and the same buffer is queued to every client.
+    Frames that a client compresses still go through its own zlib stream.
+    """
+    with tracer.span("fan_out", clients=len(clients)):
+        payloads = {}
+        frames = {}
+        for client in clients:
+            if (payload := payloads.get(client.codec)) is None:
+                payload = payloads[client.codec] = client.encode(data)
+
+            if client.compresses(payload):
+                client.enqueue(payload, key)
+                continue
+
+            if (frame := frames.get((client.codec, client.version))) is None:
+                frame = frames[client.codec, client.version] = client.frame(payload)
+            client.enqueue(frame, key, framed=True)
@@ -0,0 +1,130 @@
+import heapq
+import secrets
+import time
+from threading import Lock
+
+from utils import PerDatabase, QueryExecutor
+
+
+class CodeStore(PerDatabase):
+    """
+    Validation codes by username, which expire after ttl seconds and allow max_attempts wrong guesses.
+    Expired codes are found on a heap ordered by expiry, so cleaning up never scans all the codes.
+    At most max_entries codes are kept, the ones closest to expiring are dropped first.
+    When persistent, the codes are only kept in the database, which every worker process reads and updates with single
+    statements, so they survive restarts and a code can't be used twice or guessed more often through other workers.
+    """
+    ttl = 15 * 60  # Seconds.
+    max_entries = 10000
+    max_attempts = 5
+    persistent = False
+
+    def __init__(self, execute_query: QueryExecutor = None):
+        self.execute_query = execute_query if self.persistent else None
+
+        self.lock = Lock()
+        self.codes = {}  # Username -> [code, expiry, attempts], unless persistent.
+        self.expiries = []  # Heap of (expiry, username), entries of replaced codes are skipped.
+
+        # Store metrics.
+        self.expired = 0
+        self.evicted = 0
+        self.locked_out = 0
+
+        if self.execute_query is not None:
+            self.execute_query("DELETE FROM tblValidationCodes WHERE expiry<?", [time.time()])
+
+    def issue(self, username: str) -> str:
+        """
+        The user's code, a new one unless a code was already sent. Either way it is valid for another ttl seconds.
+        """
+        if self.execute_query is not None:
+            return self.issue_stored(username)
+
+        with self.lock:
+            self.purge()
+            entry = self.codes.get(username) or [f"{secrets.randbelow(900000) + 100000}", 0, 0]
+            entry[1] = time.time() + self.ttl
+            self.put(username, entry)
+
+            while len(self.codes) > self.max_entries:
+                expiry, evicted = heapq.heappop(self.expiries)
+                if (other := self.codes.get(evicted)) is not None and other[1] == expiry:
+                    self.remove(evicted)
+                    self.evicted += 1
+            return entry[0]
+
+    def validate(self, username: str, code: str) -> None:
+        """
+        Raises an AssertionError unless the code is the user's valid code, a valid code can only be used once.
+        """
+        if self.execute_query is not None:
+            return self.validate_stored(username, code)
+
+        with self.lock:
+            self.purge()
+            entry = self.codes.get(username)
+            assert entry is not None, "No valid validation code, ask for a new one"
+
+            if code != entry[0]:
+                entry[2] += 1
+                if entry[2] >= self.max_attempts:
+                    self.remove(username)
+                    self.locked_out += 1
+                    raise AssertionError("Too many wrong validation codes, ask for a new one")
+                raise AssertionError(f"Wrong validation code {code}")
+
+            # Invalidating the validation code so that it will only be used once.
+            self.remove(username)
+
+    def issue_stored(self, username: str) -> str:
+        now = time.time()
+        expired = self.execute_query("DELETE FROM tblValidationCodes WHERE expiry<=? RETURNING username", [now])
+        # A code that was already sent, by any process, is kept.
+        rows = self.execute_query("INSERT INTO tblValidationCodes VALUES (?, ?, ?, 0) "
+                                  "ON CONFLICT (username) DO UPDATE SET expiry=excluded.expiry RETURNING code",
+                                  [username, f"{secrets.randbelow(900000) + 100000}", now + self.ttl])
+        with self.lock:
+            self.expired += len(expired)
+        return rows[0][0]
+
+    def validate_stored(self, username: str, code: str) -> None:
+        now = time.time()
+        # Invalidating the validation code so that it will only be used once.
+        if self.execute_query("DELETE FROM tblValidationCodes WHERE username=? AND code=? AND expiry>? RETURNING code",
+                              [username, code, now]):
+            return
+
+        rows = self.execute_query("UPDATE tblValidationCodes SET attempts=attempts+1 WHERE username=? AND expiry>? "
+                                  "RETURNING attempts", [username, now])
+        assert rows, "No valid validation code, ask for a new one"
+
+        if rows[0][0] >= self.max_attempts:
+            self.execute_query("DELETE FROM tblValidationCodes WHERE username=?", [username])
+            with self.lock:
+                self.locked_out += 1
+            raise AssertionError("Too many wrong validation codes, ask for a new one")
+        raise AssertionError(f"Wrong validation code {code}")
+
+    def put(self, username: str, entry: list) -> None:
+        self.codes[username] = entry
+        heapq.heappush(self.expiries, (entry[1], username))
+
+    def remove(self, username: str) -> None:
+        self.codes.pop(username, None)
+
+    def purge(self) -> None:
+        """
+        Drop the expired codes, must be called while holding the lock.
+        """
+        now = time.time()
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, username = heapq.heappop(self.expiries)
+            # Skipping entries of codes that were replaced, used or given more time.
+            if (entry := self.codes.get(username)) is not None and entry[1] == expiry:
+                self.remove(username)
+                self.expired += 1
+
+    def stats(self) -> dict:
+        return {'codes': len(self.codes), 'expired': self.expired, 'evicted': self.evicted,
+                'locked_out': self.locked_out}
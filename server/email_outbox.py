@@ -0,0 +1,181 @@
+"""
+Outgoing emails, queued and sent by a small pool of workers which keep their SMTP sessions open between emails.
+"""
+import email
+import heapq
+import itertools
+import os
+import random
+import smtplib
+import time
+import uuid
+from _thread import start_new_thread
+from email.message import EmailMessage
+from email.policy import default
+from threading import Condition
+
+from utils import PerDatabase, QueryExecutor
+
+# Set your credentials here to send email
+credentials = os.environ.get("EMAIL_ADDRESS"), os.environ.get("EMAIL_PASSWORD")
+
+# Every process of the same server run shares this id, emails left by older runs are taken over on startup.
+BOOT = uuid.uuid4().hex
+
+
+class EmailOutbox(PerDatabase):
+    """
+    Queue of emails drained by `workers` threads, failed emails are retried with exponential backoff.
+    When persistent, queued emails are also kept in the database until they were sent, and survive restarts.
+    """
+    host = os.environ.get("SMTP_HOST")  # None: smtp.gmail.com, printing the emails when no credentials are set.
+    port = int(os.environ.get("SMTP_PORT", 587))
+    workers = 2
+    persistent = False
+
+    max_attempts = 6
+    backoff = 1  # Seconds before the first retry, doubled on every attempt.
+    max_backoff = 300
+    idle_timeout = 60  # Seconds an unused SMTP session stays open.
+
+    def __init__(self, execute_query: QueryExecutor = None):
+        self.execute_query = execute_query if self.persistent else None
+
+        self.queue = []  # Heap of (time of the next attempt, order, email, attempts, row id).
+        self.queue_changed = Condition()
+        self.order = itertools.count()
+
+        # Outbox metrics.
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.sessions = 0
+
+        if self.execute_query is not None:
+            self.restore()
+
+        for _ in range(self.workers):
+            start_new_thread(self.work, ())
+
+    def send(self, message: EmailMessage) -> None:
+        """
+        Queue the email, never waits for the SMTP server.
+        """
+        row = None
+        if self.execute_query is not None:
+            row = self.execute_query("INSERT INTO tblEmails (message, attempts, boot) VALUES (?, 0, ?) RETURNING id",
+                                     [message.as_string(), BOOT])[0][0]
+        self.put(time.time(), message, 0, row)
+
+    def put(self, when: float, message: EmailMessage, attempts: int, row: int) -> None:
+        with self.queue_changed:
+            heapq.heappush(self.queue, (when, next(self.order), message, attempts, row))
+            self.queue_changed.notify()
+
+    def restore(self) -> None:
+        # Taking over the emails of older runs, exactly one process gets each of them.
+        for message, attempts in self.execute_query("DELETE FROM tblEmails WHERE boot<>? RETURNING message, attempts",
+                                                    [BOOT]):
+            row = self.execute_query("INSERT INTO tblEmails (message, attempts, boot) VALUES (?, ?, ?) RETURNING id",
+                                     [message, attempts, BOOT])[0][0]
+            self.put(time.time(), email.message_from_string(message, policy=default), attempts, row)
+
+    def take(self, timeout: float):
+        """
+        The next email that is due, None if there was none for timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        with self.queue_changed:
+            while True:
+                now = time.time()
+                if self.queue and self.queue[0][0] <= now:
+                    return heapq.heappop(self.queue)
+
+                if (wait := deadline - time.monotonic()) <= 0:
+                    return None
+                if self.queue:
+                    wait = min(wait, self.queue[0][0] - now)
+                self.queue_changed.wait(wait)
+
+    def work(self) -> None:
+        session = None
+        while True:
+            if (item := self.take(self.idle_timeout)) is None:
+                # Closing the idle session, the next email opens a new one.
+                session = self.close(session)
+                continue
+
+            _, _, message, attempts, row = item
+            try:
+                session = self.deliver(session, message)
+            except Exception as e:
+                session = self.close(session)
+                self.retry(message, attempts + 1, row, e)
+                continue
+
+            self.sent += 1
+            if row is not None:
+                self.execute_query("DELETE FROM tblEmails WHERE id=?", [row])
+
+    def deliver(self, session: smtplib.SMTP, message: EmailMessage) -> smtplib.SMTP:
+        """
+        Send the email over the session, opening a new one if needed. Returns the session to reuse.
+        """
+        if self.host is None and None in credentials:
+            print(f"No email credentials are set, printing email:\n{message}")
+            return session
+
+        if session is not None:
+            try:
+                session.send_message(message)
+                return session
+            except smtplib.SMTPServerDisconnected:
+                # The server closed the idle session, retrying once on a new one.
+                session = None
+
+        session = self.connect()
+        session.send_message(message)
+        return session
+
+    def connect(self) -> smtplib.SMTP:
+        session = smtplib.SMTP(self.host or "smtp.gmail.com", port=self.port, timeout=30)
+        try:
+            session.ehlo()
+            if session.has_extn("starttls"):
+                session.starttls()
+                session.ehlo()
+            if None not in credentials:
+                session.login(*credentials)
+        except Exception:
+            session.close()
+            raise
+        self.sessions += 1
+        return session
+
+    @staticmethod
+    def close(session: smtplib.SMTP):
+        if session is not None:
+            try:
+                session.quit()
+            except Exception:
+                session.close()
+        return None
+
+    def retry(self, message: EmailMessage, attempts: int, row: int, error: Exception) -> None:
+        if attempts >= self.max_attempts:
+            self.failed += 1
+            print(f"Failed to send email after {attempts} attempts, printing email:\n{message}\n\nERROR: {error}")
+            if row is not None:
+                self.execute_query("DELETE FROM tblEmails WHERE id=?", [row])
+            return
+
+        self.retries += 1
+        # Exponential backoff with jitter, so that many failed emails don't retry all at once.
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff) * random.uniform(0.5, 1.5)
+        if row is not None:
+            self.execute_query("UPDATE tblEmails SET attempts=? WHERE id=?", [attempts, row])
+        self.put(time.time() + delay, message, attempts, row)
+
+    def stats(self) -> dict:
+        return {'queued': len(self.queue), 'sent': self.sent, 'failed': self.failed, 'retries': self.retries,
+                'sessions': self.sessions}
@@ -0,0 +1,149 @@
+"""
+Application-level heartbeats: clients that negotiated them are pinged after a silence,
+and disconnected when they don't answer in time.
+Other clients rely on TCP keepalive, which the kernel runs for every connection.
+"""
+import math
+import socket
+import time
+from _thread import start_new_thread
+from threading import Lock
+
+import metrics
+from client import Client
+from smart_socket import PING
+
+pings = metrics.registry.counter("chat_pings_total", "Heartbeats sent to silent clients.")
+reaped = metrics.registry.counter("chat_reaped_connections_total",
+                                  "Dead connections that were disconnected, by how they were found.", "reason")
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel: a ring of slots of tick seconds each, a timer lives in the slot of its deadline.
+    Scheduling and cancelling cost O(1), and advancing the wheel only touches the timers that expired.
+    Deadlines further than the wheel's span expire early, their owner is expected to schedule them again.
+    """
+
+    def __init__(self, tick: float, span: float):
+        self.tick = tick
+        self.slots = [set() for _ in range(math.ceil(span / tick) + 2)]
+        self.where = {}  # Item -> index of its slot.
+        self.position = 0  # Index of the next slot to expire.
+        self.time = time.monotonic() + tick  # When the slot at position expires.
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, item, deadline: float) -> None:
+        self.cancel(item)
+        ticks = min(max(math.ceil((deadline - self.time) / self.tick), 0), len(self.slots) - 1)
+        index = (self.position + ticks) % len(self.slots)
+        self.slots[index].add(item)
+        self.where[item] = index
+
+    def cancel(self, item) -> None:
+        if (index := self.where.pop(item, None)) is not None:
+            self.slots[index].discard(item)
+
+    def advance(self, now: float) -> list:
+        """
+        Expire the slots whose time has come, returns their items.
+        """
+        expired = []
+        while self.time <= now:
+            if slot := self.slots[self.position]:
+                self.slots[self.position] = set()
+                for item in slot:
+                    del self.where[item]
+                expired.extend(slot)
+            self.position = (self.position + 1) % len(self.slots)
+            self.time += self.tick
+        return expired
+
+
+class Reaper:
+    """
+    Every client is on a timer wheel, due when it will have been silent for ping_interval seconds.
+    Activity doesn't touch the wheel: a client that was heard from meanwhile is just scheduled again when it is due,
+    so the reaper's work is proportional to the timers that expire, not to the connected clients or the traffic.
+    """
+    ping_interval = 30  # Seconds of silence before a client is pinged.
+    ping_timeout = 15  # Seconds a pinged client has to answer.
+    tick = 0.5  # Resolution of the wheel, in seconds.
+    keepalive = True  # Enable TCP keepalive, probing silent connections every ping_interval seconds.
+
+    def __init__(self):
+        self.lock = Lock()
+        self.wheel = None
+
+    def start(self) -> None:
+        with self.lock:
+            if self.wheel is not None:
+                return
+            self.wheel = TimerWheel(self.tick, max(self.ping_interval, self.ping_timeout))
+        metrics.registry.gauge("chat_heartbeat_clients", "Clients watched for heartbeats.", lambda: len(self.wheel))
+        start_new_thread(self.run, ())
+
+    def add(self, client: Client, sock: socket.socket = None) -> None:
+        if self.keepalive and sock is not None:
+            self.set_keepalive(sock)
+        if self.wheel is None:
+            return
+        with self.lock:
+            self.wheel.schedule(client, client.last_seen + self.ping_interval)
+
+    def remove(self, client: Client) -> None:
+        if self.wheel is None:
+            return
+        with self.lock:
+            self.wheel.cancel(client)
+
+    def set_keepalive(self, sock: socket.socket) -> None:
+        """
+        Let the kernel probe the connection after ping_interval seconds of silence,
+        so that vanished peers of clients without heartbeats also fail their reads (with a TimeoutError).
+        """
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(int(self.ping_interval), 1))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(int(self.ping_timeout / 3), 1))
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+        except OSError:
+            pass
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.tick)
+            now = time.monotonic()
+            with self.lock:
+                for client in self.wheel.advance(now):
+                    self.check(client, now)
+
+    def check(self, client: Client, now: float) -> None:
+        """
+        Ping, disconnect or reschedule a client that is due, must be called while holding the lock.
+        """
+        if "heartbeat" not in client.features:
+            # The client can't answer pings, it is left to TCP keepalive.
+            return
+
+        if client.pinged_at is not None and client.last_seen < client.pinged_at:
+            if now - client.pinged_at >= self.ping_timeout:
+                reaped.inc(label="heartbeat")
+                # The receiving side gets an error and removes the client.
+                client.disconnect()
+            else:
+                self.wheel.schedule(client, client.pinged_at + self.ping_timeout)
+        elif now - client.last_seen >= self.ping_interval:
+            client.pinged_at = now
+            client.send({'type': PING})
+            pings.inc()
+            self.wheel.schedule(client, now + self.ping_timeout)
+        else:
+            client.pinged_at = None
+            self.wheel.schedule(client, client.last_seen + self.ping_interval)
+
+
+reaper = Reaper()
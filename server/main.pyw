@@ -1,43 +1,237 @@
+import argparse
+import asyncio
+import os
+import signal
 import socket
+import traceback
 from _thread import start_new_thread
 
-from client import Client
+import async_server
+import metrics
+import migrations
+import rate_limit
+import sharding
+from client import OVERFLOW_POLICIES, Client
+from code_store import CodeStore
+from email_outbox import EmailOutbox
+from heartbeats import Reaper, reaped, reaper
+from passwords import PasswordHasher
+from presence import Presence
+from profiling import Profiler, profiler
 from requests_handler import RequestsHandler
+from room_backlog import RoomBacklog
+from smart_socket import Socket, compression_stats
+from tracing import Tracer, tracer
+from user_cache import UserCache
+from utils import QueryExecutor
 
 IP = "127.0.0.1"
 PORT = 65432
 
-clients = []
-
 
 def main():
-    with socket.create_server((IP, PORT)) as server:
+    parser = argparse.ArgumentParser(description="Chat application server.")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded",
+                        help="threaded: one thread per connection, async: single event loop")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="number of threads running commands in async mode, as many run the commands that "
+                             "hash passwords")
+    parser.add_argument("--compression-threshold", type=int, default=Socket.compression_threshold,
+                        help="compress frames of at least this many bytes, for clients that support it")
+    parser.add_argument("--queue-size", type=int, default=Client.max_queue,
+                        help="outbound events that may wait for a single client")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default=Client.overflow_policy,
+                        help="what to do when the outbound queue of a client is full")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port, connected by a local bus")
+    parser.add_argument("--database", default=RequestsHandler.database, help="path of the sqlite database")
+    parser.add_argument("--commit-window", type=float, default=QueryExecutor.commit_window,
+                        help="seconds to wait for more writes before committing them together")
+    parser.add_argument("--hash-cost", type=int, default=PasswordHasher.iterations,
+                        help="PBKDF2 iterations of new password hashes")
+    parser.add_argument("--hash-workers", type=int, default=PasswordHasher.workers,
+                        help="password hashes computed at the same time")
+    parser.add_argument("--backlog-messages", type=int, default=RoomBacklog.max_messages,
+                        help="recent messages of every room sent to the clients entering it")
+    parser.add_argument("--backlog-bytes", type=int, default=RoomBacklog.max_bytes,
+                        help="memory kept for the recent messages of every room")
+    parser.add_argument("--smtp-host", default=EmailOutbox.host, help="SMTP server sending the emails")
+    parser.add_argument("--smtp-port", type=int, default=EmailOutbox.port)
+    parser.add_argument("--email-workers", type=int, default=EmailOutbox.workers,
+                        help="emails sent at the same time, each worker keeps its own SMTP session")
+    parser.add_argument("--persistent-outbox", action="store_true",
+                        help="keep unsent emails in the database, so they are sent after a restart")
+    parser.add_argument("--code-ttl", type=float, default=CodeStore.ttl, help="seconds a validation code is valid")
+    parser.add_argument("--persistent-codes", action="store_true",
+                        help="keep validation codes in the database, so they are still valid after a restart")
+    parser.add_argument("--rate-limit", type=rate_limit.parse_limit, action="append", default=[],
+                        metavar="SCOPE:COMMAND=RATE/BURST",
+                        help="requests per second and burst of a command, per client or per address, "
+                             "e.g. client:send_message=5/20 (may be repeated)")
+    parser.add_argument("--no-rate-limit", action="store_true", help="don't limit the rate of the requests")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the metrics on http://127.0.0.1:PORT/metrics, worker processes use the next ports")
+    parser.add_argument("--admins", nargs="+", default=[], metavar="USERNAME",
+                        help="users allowed to run the stats, profile and trace commands")
+    parser.add_argument("--trace", action="store_true", help="trace the requests from the start")
+    parser.add_argument("--trace-file", default=Tracer.path,
+                        help="JSON lines file of the request traces, worker processes add their index to the name")
+    parser.add_argument("--trace-max-bytes", type=int, default=Tracer.max_bytes,
+                        help="size of the trace file before it is rotated")
+    parser.add_argument("--trace-backups", type=int, default=Tracer.backups, help="rotated trace files kept")
+    parser.add_argument("--trace-sample", type=float, default=Tracer.sample, help="fraction of the requests traced")
+    parser.add_argument("--profile-seconds", type=float, default=Profiler.seconds,
+                        help="time window of a profile started by SIGUSR2 (or without seconds by the profile command)")
+    parser.add_argument("--profile-dir", default=Profiler.directory, help="directory of the profiles")
+    parser.add_argument("--ping-interval", type=float, default=Reaper.ping_interval,
+                        help="seconds of silence before a client is pinged (and probed by TCP keepalive)")
+    parser.add_argument("--ping-timeout", type=float, default=Reaper.ping_timeout,
+                        help="seconds a pinged client has to answer before it is disconnected")
+    args = parser.parse_args()
+
+    Socket.compression_threshold = args.compression_threshold
+    Client.max_queue = args.queue_size
+    Client.overflow_policy = args.overflow
+    RequestsHandler.database = args.database
+    QueryExecutor.commit_window = args.commit_window
+    PasswordHasher.iterations = args.hash_cost
+    PasswordHasher.workers = args.hash_workers
+    RoomBacklog.max_messages = args.backlog_messages
+    RoomBacklog.max_bytes = args.backlog_bytes
+    EmailOutbox.host = args.smtp_host
+    EmailOutbox.port = args.smtp_port
+    EmailOutbox.workers = args.email_workers
+    EmailOutbox.persistent = args.persistent_outbox
+    CodeStore.ttl = args.code_ttl
+    CodeStore.persistent = args.persistent_codes
+    limits = {scope: dict(commands) for scope, commands in rate_limit.DEFAULT_LIMITS.items()}
+    for scope, command, limit in args.rate_limit:
+        limits[scope][command] = limit
+    rate_limit.limits.configure({} if args.no_rate_limit else limits)
+    RequestsHandler.admins = set(args.admins)
+    Tracer.path = args.trace_file
+    Tracer.max_bytes = args.trace_max_bytes
+    Tracer.backups = args.trace_backups
+    Tracer.sample = args.trace_sample
+    Profiler.seconds = args.profile_seconds
+    Profiler.directory = args.profile_dir
+    Reaper.ping_interval = args.ping_interval
+    Reaper.ping_timeout = args.ping_timeout
+
+    # SIGUSR1 turns tracing on and off, SIGUSR2 starts a profile, the handlers are inherited by worker processes.
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, tracer.toggle)
+        signal.signal(signal.SIGUSR2, profiler.signal)
+
+    # Upgrading the database before any handler uses it.
+    migrations.migrate(args.database)
+
+    def listen(reuse_port: bool = False) -> socket.socket:
+        return socket.create_server((IP, args.port), reuse_port=reuse_port)
+
+    def serve(server: socket.socket, clients: Presence):
+        register_gauges(clients, args.database)
+        if isinstance(clients, sharding.ShardedPresence):
+            # Users changed by a worker are dropped from the caches of the others.
+            users = UserCache.shared(args.database)
+            users.listeners.append(clients.publish_user_change)
+            clients.user_listeners.append(lambda username: users.invalidate(username, notify=False))
+        reaper.start()
+        if args.metrics_port is not None:
+            metrics.serve(args.metrics_port + clients.worker)
+        if args.processes > 1:
+            root, extension = os.path.splitext(args.trace_file)
+            tracer.path = f"{root}-{clients.worker}{extension}"
+        if args.trace:
+            tracer.enable()
+
+        if args.mode == "async":
+            asyncio.run(async_server.serve(server, clients, args.workers))
+        else:
+            serve_threaded(server, clients)
+
+    if args.processes > 1:
+        sharding.run(args.processes, listen, serve, sharding.BUS_PATH.format(port=args.port))
+    else:
+        serve(listen(), Presence())
+
+
+def serve_threaded(server: socket.socket, clients: Presence):
+    with server:
         server.listen()
 
         while True:
             client, address = server.accept()
+            metrics.connections.inc()
             client = Client(client)
-            clients.append(client)
-            start_new_thread(handle_client, (client,))
+            clients.add(client)
+            reaper.add(client, client.socket)
+            client.start_writer()
+            start_new_thread(handle_client, (client, clients))
+
 
+def register_gauges(clients: Presence, database: str):
+    """
+    Gauges of the server's state, computed when the metrics are collected.
+    """
+    registry = metrics.registry
+    registry.gauge("chat_connected_clients", "Connected clients.", lambda: len(clients))
+    registry.gauge("chat_authenticated_clients", "Logged in clients.", lambda: len(clients.authenticated()))
+    registry.gauge("chat_room_clients", "Clients in every room.", clients.occupancy, "room")
+    registry.gauge("chat_outbound_queued_events", "Events waiting in the outbound queues of the clients.",
+                   lambda: sum(client.queue_depth for client in clients))
+    registry.gauge("chat_backlog_bytes", "Memory of the recent messages of every room.",
+                   lambda: {stats['room']: stats['bytes'] for stats in clients.backlog_stats()}, "room")
+    registry.gauge("chat_rate_limited_total", "Requests rejected by the rate limits, by command.",
+                   lambda: dict(rate_limit.limits.rejected), "command", "counter")
+    registry.gauge("chat_user_cache_lookups_total", "Lookups of the user cache, by result.",
+                   lambda: {key: value for key, value in UserCache.shared(database).stats().items()
+                            if key in ("hits", "misses")}, "result", "counter")
+    registry.gauge("chat_database_commits_total", "Commits of grouped writes.",
+                   lambda: QueryExecutor.shared(database).commits, kind="counter")
+    registry.gauge("chat_database_writes_total", "Writes committed.",
+                   lambda: QueryExecutor.shared(database).written, kind="counter")
+    registry.gauge("chat_emails_queued", "Emails waiting to be sent.",
+                   lambda: EmailOutbox.shared(database).stats()['queued'])
+    registry.gauge("chat_compression_frames_total", "Frames compressed and decompressed.",
+                   lambda: {'compress': compression_stats.frames,
+                            'decompress': compression_stats.decompressed_frames}, "operation", "counter")
+    registry.gauge("chat_compression_bytes_total", "Bytes of the compressed frames, before and after compressing.",
+                   lambda: {'raw': compression_stats.raw_bytes, 'compressed': compression_stats.compressed_bytes},
+                   "size", "counter")
+    registry.gauge("chat_compression_seconds_total", "Time spent compressing and decompressing frames.",
+                   lambda: {'compress': compression_stats.compress_time,
+                            'decompress': compression_stats.decompress_time}, "operation", "counter")
+    registry.gauge("chat_compression_ratio", "Raw bytes per compressed byte of the compressed frames.",
+                   lambda: compression_stats.ratio)
 
-def handle_client(client: Client):
+
+def handle_client(client: Client, clients: Presence):
     handler = RequestsHandler(client, clients)
 
-    while True:
-        try:
-            request = client.receive()
-        except ConnectionResetError:
-            handler.remove_client(client)
-            break
+    try:
+        while True:
+            try:
+                request = client.receive()
+            except TimeoutError:
+                # TCP keepalive found that the peer is gone.
+                reaped.inc(label="keepalive")
+                break
+            except OSError:
+                # Connection closed, reset, or shut down by the reaper.
+                break
 
-        try:
             response = handler.handle(request)
-        except Exception as e:
-            raise e
-        else:
             if response is not None:
                 client.send(response)
+    except Exception:
+        # The connection is dropped, the server keeps running.
+        traceback.print_exc()
+    finally:
+        handler.remove_client(client)
+        client.close()
+        client.disconnect()
 
 
 if __name__ == '__main__':
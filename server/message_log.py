@@ -0,0 +1,91 @@
+import time
+from _thread import start_new_thread
+from collections import deque
+from threading import Condition
+
+from utils import PerDatabase, QueryExecutor
+
+MAX_ID = 2 ** 63 - 1  # Larger than any message id, pages start before it.
+
+
+class MessageLog(PerDatabase):
+    """
+    History of the messages sent to the rooms.
+    Messages are appended to a buffer that a background thread writes in batches,
+    so relaying a message never waits for the disk.
+    """
+    flush_interval = 0.05  # Seconds between writes of the buffer.
+    max_batch = 1000  # Messages written by a single statement.
+    max_buffer = 100000  # Messages that may wait for the disk, older messages are dropped beyond it.
+
+    def __init__(self, execute_query: QueryExecutor):
+        self.execute_query = execute_query
+
+        self.buffer = deque()  # Dropping the oldest message of a full buffer costs O(1).
+        self.buffer_changed = Condition()
+        self.flush_requested = False
+        # Sequence numbers: messages appended so far, and messages written (or dropped) so far.
+        self.appended = 0
+        self.flushed = 0
+
+        # Buffer metrics.
+        self.written = 0
+        self.dropped = 0
+
+        start_new_thread(self.flush_loop, ())
+
+    def append(self, room: str, username: str, name: str, message: str) -> None:
+        with self.buffer_changed:
+            if len(self.buffer) >= self.max_buffer:
+                self.buffer.popleft()
+                self.dropped += 1
+
+            self.buffer.append((room, username, name, message, time.time()))
+            self.appended += 1
+            if len(self.buffer) >= self.max_batch:
+                self.buffer_changed.notify_all()
+
+    def flush_loop(self) -> None:
+        while True:
+            with self.buffer_changed:
+                self.buffer_changed.wait_for(lambda: len(self.buffer) >= self.max_batch or self.flush_requested,
+                                             self.flush_interval)
+                batch, self.buffer = self.buffer, deque()
+                sequence = self.appended
+                self.flush_requested = False
+
+            if batch:
+                try:
+                    self.execute_query.submit_many(
+                        "INSERT INTO tblMessages (room, username, name, message, time) VALUES (?, ?, ?, ?, ?)",
+                        batch).result()
+                    self.written += len(batch)
+                except Exception as e:
+                    print(f"Failed to write {len(batch)} messages:", e)
+
+            with self.buffer_changed:
+                self.flushed = sequence
+                self.buffer_changed.notify_all()
+
+    def flush(self) -> None:
+        """
+        Wait until every message appended so far is written, messages appended meanwhile aren't waited for.
+        """
+        with self.buffer_changed:
+            sequence = self.appended
+            if self.flushed < sequence:
+                self.flush_requested = True
+                self.buffer_changed.notify_all()
+            self.buffer_changed.wait_for(lambda: self.flushed >= sequence)
+
+    def history(self, room: str, before: int = None, limit: int = 50) -> list[dict]:
+        """
+        The last messages of the room sent before the message with id before, oldest first.
+        Pages are found by (room, id) in the index, so older pages cost the same as the newest one.
+        """
+        self.flush()
+        rows = self.execute_query("SELECT id, username, name, message, time FROM tblMessages "
+                                  "WHERE room=? AND id<? ORDER BY id DESC LIMIT ?",
+                                  [room, MAX_ID if before is None else before, limit])
+        return [{'id': id, 'username': username, 'name': name, 'message': message, 'time': sent}
+                for id, username, name, message, sent in reversed(rows)]
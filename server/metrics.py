@@ -0,0 +1,209 @@
+"""
+Server metrics: counters, latency histograms and gauges, exposed in the Prometheus text format.
+Updates are split in shards by thread, so threads rarely wait for each other and metrics can always stay on.
+"""
+import itertools
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from _thread import start_new_thread
+from threading import Lock, local
+
+SHARDS = 16
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+shard_indexes = itertools.count()
+thread_shard = local()
+
+
+def shard_index() -> int:
+    """
+    The shard of the calling thread, threads are spread over the shards in turn.
+    """
+    try:
+        return thread_shard.index
+    except AttributeError:
+        thread_shard.index = next(shard_indexes) % SHARDS
+        return thread_shard.index
+
+
+class Sharded:
+    """
+    A few numbers updated by many threads, each thread updates its own shard.
+    """
+
+    def __init__(self, size: int):
+        self.shards = [(Lock(), [0] * size) for _ in range(SHARDS)]
+
+    def add(self, index: int, amount=1, total_index: int = None) -> None:
+        lock, values = self.shards[shard_index()]
+        with lock:
+            values[index] += 1 if total_index is not None else amount
+            if total_index is not None:
+                values[total_index] += amount
+
+    def totals(self) -> list:
+        result = None
+        for lock, values in self.shards:
+            with lock:
+                result = list(values) if result is None else [a + b for a, b in zip(result, values)]
+        return result
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}  # Label value -> Sharded.
+        self.lock = Lock()
+
+    def series(self, label, size: int) -> Sharded:
+        if (values := self.values.get(label)) is None:
+            with self.lock:
+                values = self.values.setdefault(label, Sharded(size))
+        return values
+
+    def inc(self, amount=1, label=None) -> None:
+        self.series(label, 1).add(0, amount)
+
+    def collect(self) -> dict:
+        return {label: values.totals()[0] for label, values in list(self.values.items())}
+
+    def exposition(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{labels(self.label, label)} {value}" for label, value in self.collect().items()]
+        return lines
+
+
+class Histogram(Counter):
+    """
+    Counts of observations per bucket, plus their sum.
+    """
+
+    def __init__(self, name: str, help: str, label: str = None, buckets: tuple = LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, label)
+        self.buckets = buckets
+
+    def observe(self, value: float, label=None) -> None:
+        # Buckets, then the count of the values above all of them, then the sum.
+        self.series(label, len(self.buckets) + 2).add(bisect_left(self.buckets, value), value, len(self.buckets) + 1)
+
+    def collect(self) -> dict:
+        result = {}
+        for label, values in list(self.values.items()):
+            totals = values.totals()
+            cumulative = list(itertools.accumulate(totals[:-1]))
+            result[label] = {'count': cumulative[-1], 'sum': totals[-1],
+                             'buckets': {**{str(bound): count for bound, count in zip(self.buckets, cumulative)},
+                                         '+Inf': cumulative[-1]}}
+        return result
+
+    def exposition(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label, value in self.collect().items():
+            for bound, count in value['buckets'].items():
+                lines.append(f"{self.name}_bucket{labels(self.label, label, le=bound)} {count}")
+            lines.append(f"{self.name}_sum{labels(self.label, label)} {value['sum']}")
+            lines.append(f"{self.name}_count{labels(self.label, label)} {value['count']}")
+        return lines
+
+
+class Gauge:
+    """
+    A value computed when the metrics are collected.
+    function returns a number, or a dict of numbers by label value.
+    kind is "counter" when the value only grows, e.g. the totals kept by other parts of the server.
+    """
+
+    def __init__(self, name: str, help: str, function, label: str = None, kind: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.label = label
+        self.kind = kind
+
+    def collect(self) -> dict:
+        value = self.function()
+        return value if isinstance(value, dict) else {None: value}
+
+    def exposition(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{labels(self.label, label)} {value}" for label, value in self.collect().items()]
+        return lines
+
+
+def labels(name: str, value, **extra) -> str:
+    pairs = ([(name, value)] if name is not None and value is not None else []) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(item)}"' for key, item in pairs) + "}"
+
+
+def escape(value) -> str:
+    # Label values may contain anything, the text format only escapes these.
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, label: str = None) -> Counter:
+        return self.register(Counter(name, help, label))
+
+    def histogram(self, name: str, help: str, label: str = None) -> Histogram:
+        return self.register(Histogram(name, help, label))
+
+    def gauge(self, name: str, help: str, function, label: str = None, kind: str = "gauge") -> Gauge:
+        return self.register(Gauge(name, help, function, label, kind))
+
+    def snapshot(self) -> dict:
+        """
+        Every metric by name, then by label value ("" when the metric has no label).
+        """
+        return {name: {"" if label is None else label: value for label, value in metric.collect().items()}
+                for name, metric in list(self.metrics.items())}
+
+    def exposition(self) -> str:
+        return "\n".join(line for metric in list(self.metrics.values()) for line in metric.exposition()) + "\n"
+
+
+registry = Registry()
+
+requests = registry.counter("chat_requests_total", "Requests handled, by command.", "command")
+request_errors = registry.counter("chat_request_errors_total", "Requests that raised an error, by command.", "command")
+request_seconds = registry.histogram("chat_request_seconds", "Time spent handling requests, by command.", "command")
+connections = registry.counter("chat_connections_total", "Connections accepted.")
+outbound_bytes = registry.counter("chat_outbound_bytes_total", "Bytes written to the clients.")
+
+
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serve the metrics in the Prometheus text format on http://host:port/metrics, in the background.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = registry.exposition().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    start_new_thread(server.serve_forever, ())
+    return server
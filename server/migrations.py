@@ -0,0 +1,158 @@
+"""
+Versioned schema of the server's database.
+The version of a database is kept in its user_version pragma, and every migration newer than it is applied in order
+when the server starts.
+
+Checking that every query of the request handlers is served by an index:
+
+    python migrations.py --check
+"""
+import argparse
+import ast
+import os
+import sqlite3
+import sys
+
+# Migrations by version, each one a list of statements applied in a single transaction.
+MIGRATIONS = [
+    # 1: The original users table.
+    [
+        """CREATE TABLE IF NOT EXISTS "tblUsers"
+        (
+            username TEXT
+                primary key
+                unique,
+            name TEXT,
+            email TEXT,
+            password TEXT,
+            isActive INTEGER,
+            phoneNumber TEXT
+        )""",
+    ],
+    # 2: signup looks users up by email.
+    [
+        "CREATE INDEX IF NOT EXISTS idxUsersEmail ON tblUsers (email)",
+    ],
+    # 3: Message history, paged backwards by (room, id).
+    [
+        """CREATE TABLE IF NOT EXISTS tblMessages
+        (
+            id INTEGER
+                primary key,
+            room TEXT,
+            username TEXT,
+            name TEXT,
+            message TEXT,
+            time REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idxMessagesRoom ON tblMessages (room, id)",
+    ],
+    # 4: Emails waiting to be sent, kept by the persistent outbox.
+    [
+        """CREATE TABLE IF NOT EXISTS tblEmails
+        (
+            id INTEGER
+                primary key,
+            message TEXT,
+            attempts INTEGER,
+            boot TEXT
+        )""",
+    ],
+    # 5: Validation codes, kept by the persistent code store.
+    [
+        """CREATE TABLE IF NOT EXISTS tblValidationCodes
+        (
+            username TEXT
+                primary key,
+            code TEXT,
+            expiry REAL,
+            attempts INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idxValidationCodesExpiry ON tblValidationCodes (expiry)",
+    ],
+]
+
+# Modules whose queries are checked, relative to this directory.
+QUERY_MODULES = ("requests_handler.py", "user_cache.py", "message_log.py", "code_store.py")
+
+
+def version(db: sqlite3.Connection) -> int:
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path: str) -> int:
+    """
+    Upgrade the database at path to the latest version, returns the version it was in.
+    """
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        db.execute("BEGIN IMMEDIATE")
+        current = version(db)
+        for number, statements in enumerate(MIGRATIONS[current:], current + 1):
+            for statement in statements:
+                db.execute(statement)
+            # Pragmas don't take parameters, number is an int.
+            db.execute(f"PRAGMA user_version={number}")
+        db.execute("COMMIT")
+        return current
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    finally:
+        db.close()
+
+
+def queries(directory: str = os.path.dirname(os.path.abspath(__file__))) -> list[str]:
+    """
+    Every SQL string literal passed to execute_query by the query modules.
+    """
+    result = []
+    for module in QUERY_MODULES:
+        with open(os.path.join(directory, module)) as file:
+            tree = ast.parse(file.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and \
+                    node.func.attr == "execute_query" and node.args and isinstance(node.args[0], ast.Constant):
+                result.append(node.args[0].value)
+    return result
+
+
+def full_scans(db: sqlite3.Connection, query: str) -> list[str]:
+    """
+    The steps of the query's plan that read a whole table.
+    """
+    plan = db.execute(f"EXPLAIN QUERY PLAN {query}", [None] * query.count("?"))
+    return [detail for _, _, _, detail in plan if detail.startswith("SCAN")]
+
+
+def check_plans(path: str) -> dict[str, list[str]]:
+    """
+    Queries that read a whole table on the (migrated) database at path, with the offending plan steps.
+    """
+    db = sqlite3.connect(path)
+    try:
+        return {query: scans for query in queries() if (scans := full_scans(db, query))}
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the chat database.")
+    parser.add_argument("--database", default="database/database.db")
+    parser.add_argument("--check", action="store_true",
+                        help="fail if a query of the request handlers is not served by an index")
+    args = parser.parse_args()
+
+    previous = migrate(args.database)
+    print(f"{args.database}: version {previous} -> {len(MIGRATIONS)}")
+
+    if args.check:
+        if failures := check_plans(args.database):
+            for query, scans in failures.items():
+                print(f"ERROR: {' '.join(query.split())} ({'; '.join(scans)})")
+            sys.exit(1)
+        print(f"All {len(queries())} queries use an index.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Salted PBKDF2 password hashes, computed on a bounded pool of threads.
+hashlib releases the GIL while it hashes, so a login storm keeps at most `workers` cores busy
+and the other connections (and the event loop in async mode) keep running.
+
+Hashes are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>".
+Hashes made by older versions of the server are a plain SHA-256 hex digest, they are still accepted and need a rehash.
+"""
+import hashlib
+import hmac
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+
+from utils import encrypt
+
+ALGORITHM = "pbkdf2_sha256"
+
+
+class PasswordHasher:
+    iterations = 200000  # Cost of a single hash.
+    workers = os.cpu_count() or 1  # Hashes computed at the same time.
+    salt_size = 16
+
+    def __init__(self):
+        self.pool = None
+        self.pool_lock = Lock()
+
+    def submit(self, function, *args) -> Future:
+        # Creating the pool on first use, after the server's settings were applied.
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="hasher")
+        return self.pool.submit(function, *args)
+
+    def hash(self, password: str) -> str:
+        return self.submit(self.compute, password, self.salt(), self.iterations).result()
+
+    def salt(self) -> bytes:
+        return os.urandom(self.salt_size)
+
+    def verify(self, password: str, stored: str) -> tuple[bool, bool]:
+        """
+        Returns whether the password matches the stored hash, and whether the stored hash should be replaced.
+        """
+        if not stored.startswith(ALGORITHM + "$"):
+            # An unsalted SHA-256 hash.
+            return hmac.compare_digest(stored, encrypt(password)), True
+
+        _, iterations, salt, _ = stored.split("$")
+        computed = self.submit(self.compute, password, bytes.fromhex(salt), int(iterations)).result()
+        return hmac.compare_digest(stored, computed), int(iterations) != self.iterations
+
+    @staticmethod
+    def compute(password: str, salt: bytes, iterations: int) -> str:
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+        return f"{ALGORITHM}${iterations}${salt.hex()}${digest.hex()}"
+
+
+hasher = PasswordHasher()
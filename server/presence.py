@@ -0,0 +1,118 @@
+from threading import RLock
+
+from client import Client, broadcast
+from room_backlog import RoomBacklog
+
+
+class Presence:
+    """
+    Registry of the connected clients, indexed by username and by room,
+    so that lookups and fan-outs cost O(room size) instead of O(connected clients).
+    """
+    worker = 0  # Index of the worker process, when the server is sharded.
+
+    def __init__(self):
+        self.lock = RLock()
+
+        self.clients = set()  # Every connected client.
+        self.by_username = {}  # Authenticated clients.
+        self.rooms = {}  # Room name -> clients in the room.
+        self.backlogs = {}  # Room name -> recent messages of the room.
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.clients))
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __contains__(self, client: Client):
+        return client in self.clients
+
+    def add(self, client: Client) -> None:
+        with self.lock:
+            self.clients.add(client)
+
+    def login(self, client: Client, username: str, name: str) -> bool:
+        """
+        Authenticate the client, unless the user is already connected via another client.
+        """
+        with self.lock:
+            if username in self.by_username:
+                return False
+
+            client.username = username
+            client.name = name
+            self.by_username[username] = client
+            return True
+
+    def enter_room(self, client: Client, room: str) -> None:
+        """
+        Move the client to the room, and give it the room's recent messages.
+        """
+        with self.lock:
+            self._leave_room(client)
+            client.room = room
+            self.rooms.setdefault(room, set()).add(client)
+            # While holding the lock, so every message is either in the backlog or sent to the client, never both.
+            self.backlog(room).send(client)
+
+    def _leave_room(self, client: Client) -> None:
+        if client.room is not None and (members := self.rooms.get(client.room)) is not None:
+            members.discard(client)
+            if not members:
+                del self.rooms[client.room]
+
+    def remove(self, client: Client) -> bool:
+        """
+        Returns whether the client was still registered.
+        """
+        with self.lock:
+            if client not in self.clients:
+                return False
+
+            self.clients.remove(client)
+            self._leave_room(client)
+            if self.by_username.get(client.username) is client:
+                del self.by_username[client.username]
+            return True
+
+    def get(self, username: str) -> Client:
+        return self.by_username.get(username)
+
+    def members(self, room: str) -> list[Client]:
+        with self.lock:
+            return list(self.rooms.get(room, ()))
+
+    def authenticated(self) -> list[Client]:
+        with self.lock:
+            return list(self.by_username.values())
+
+    def occupancy(self) -> dict:
+        with self.lock:
+            return {room: len(members) for room, members in self.rooms.items()}
+
+    def online(self) -> list[dict]:
+        with self.lock:
+            return [{"room": room, "username": client.username}
+                    for room, members in self.rooms.items() for client in members]
+
+    def backlog(self, room: str) -> RoomBacklog:
+        with self.lock:
+            if room not in self.backlogs:
+                self.backlogs[room] = RoomBacklog(room)
+            return self.backlogs[room]
+
+    def backlog_stats(self) -> list[dict]:
+        with self.lock:
+            return [backlog.stats() for backlog in self.backlogs.values()]
+
+    def send_to_room(self, room: str, data) -> None:
+        # Rooms are only sent messages.
+        with self.lock:
+            self.backlog(room).append(data['data'])
+            members = list(self.rooms.get(room, ()))
+        broadcast(members, data)
+
+    def send_to_all(self, data, key=None) -> None:
+        broadcast(self.authenticated(), data, key)
@@ -0,0 +1,112 @@
+"""
+Sampling profiler that can be started while the server runs, without restarting it under a profiler.
+It costs nothing until started: a background thread then samples the stacks of all the threads for a time window.
+"""
+import os
+import sys
+import time
+from _thread import get_ident, start_new_thread
+from collections import Counter
+from threading import Lock
+
+# Innermost frames of threads that wait for a socket, a lock or a queue, rather than running.
+IDLE = {("threading.py", "wait"), ("queue.py", "get"), ("selectors.py", "select"), ("socket.py", "accept"),
+        ("smart_socket.py", "read"), ("thread.py", "_worker"), ("async_server.py", "receive_async")}
+
+
+class Profiler:
+    interval = 0.005  # Seconds between samples.
+    seconds = 10  # Default time window.
+    max_seconds = 600
+    directory = "profiles"
+    top = 40  # Functions listed in the summary.
+
+    def __init__(self):
+        self.lock = Lock()
+        self.running = None  # Path of the profile being recorded.
+        self.profiles = 0
+
+    def start(self, seconds: float = None) -> str:
+        """
+        Sample the threads for the given number of seconds in the background, returns the path of the results.
+        """
+        seconds = min(float(seconds or self.seconds), self.max_seconds)
+        with self.lock:
+            if self.running is not None:
+                raise RuntimeError(f"Already profiling into {self.running}")
+            os.makedirs(self.directory, exist_ok=True)
+            self.running = os.path.join(self.directory,
+                                        time.strftime(f"profile-%Y%m%d-%H%M%S-{os.getpid()}.txt"))
+        start_new_thread(self.record, (self.running, seconds))
+        return self.running
+
+    def signal(self, signum=None, frame=None) -> None:
+        # Signal handler, a profile that is already running is left alone.
+        try:
+            self.start()
+        except RuntimeError:
+            pass
+
+    def record(self, path: str, seconds: float) -> None:
+        own = get_ident()
+        stacks = Counter()
+        samples = idle = 0
+        end = time.monotonic() + seconds
+        try:
+            while time.monotonic() < end:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE:
+                        idle += 1
+                        continue
+                    stacks[self.stack(frame)] += 1
+                samples += 1
+                time.sleep(self.interval)
+
+            self.dump(path, stacks, samples, idle, seconds)
+        finally:
+            with self.lock:
+                self.running = None
+                self.profiles += 1
+
+    @staticmethod
+    def stack(frame) -> tuple:
+        """
+        The stack of a frame, outermost function first.
+        """
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}")
+            frame = frame.f_back
+        return tuple(reversed(functions))
+
+    def dump(self, path: str, stacks: Counter, samples: int, idle: int, seconds: float) -> None:
+        """
+        Write a summary of the busiest functions to path,
+        and the sampled stacks in the collapsed format of flame graph tools next to it.
+        """
+        own, total = Counter(), Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+
+        busy = sum(stacks.values())
+        with open(path, "w") as summary:
+            summary.write(f"{samples} samples in {seconds}s, {busy} of running threads, {idle} of waiting threads\n\n")
+            summary.write(f"{'own %':>7} {'total %':>7}  function\n")
+            for function, count in own.most_common(self.top):
+                summary.write(f"{100 * count / max(busy, 1):7.1f} {100 * total[function] / max(busy, 1):7.1f}  "
+                              f"{function}\n")
+
+        with open(os.path.splitext(path)[0] + ".collapsed", "w") as collapsed:
+            for stack, count in stacks.most_common():
+                collapsed.write(f"{';'.join(stack)} {count}\n")
+
+    def stats(self) -> dict:
+        return {'running': self.running, 'profiles': self.profiles}
+
+
+profiler = Profiler()
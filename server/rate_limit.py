@@ -0,0 +1,152 @@
+"""
+Token bucket rate limits of the commands, per client and per address.
+"""
+import time
+from array import array
+from collections import Counter
+from threading import Lock
+
+ANY = "*"  # Limit of the commands that don't have their own.
+
+# Scope -> command -> (requests per second, burst).
+DEFAULT_LIMITS = {
+    'client': {
+        ANY: (20, 50),
+        "send_message": (5, 20),
+        "login": (1, 5),
+        "signup": (0.2, 5),
+        "send_validation_email": (1 / 60, 3),
+        "activate_user": (0.5, 5),
+        "reset_password": (0.5, 5),
+    },
+    'address': {
+        "login": (5, 30),
+        "signup": (0.5, 20),
+        "send_validation_email": (1 / 30, 10),
+    },
+}
+
+
+class RateLimiter:
+    """
+    Token buckets of every command for many keys (clients or addresses).
+    The buckets live in flat arrays, a key costs a dict entry and 12 bytes per limited command,
+    so hundreds of thousands of keys fit in a few tens of megabytes.
+    """
+    max_keys = 500000  # Keys tracked before the idle ones are dropped.
+
+    def __init__(self, limits: dict):
+        self.commands = {command: i for i, command in enumerate(limits)}
+        self.rates = [float(rate) for rate, _ in limits.values()]
+        self.bursts = [float(burst) for _, burst in limits.values()]
+
+        self.lock = Lock()
+        self.slots = {}  # Key -> index of its first bucket.
+        self.free = []  # Indexes of the buckets of dropped keys.
+        self.tokens = array('f')
+        self.stamps = array('d')  # Last time the tokens were refilled.
+
+    def take(self, key, command: str, now: float) -> float:
+        """
+        Take a token of the command's bucket, returns 0 when allowed, or the seconds until a token is available.
+        """
+        if (i := self.commands.get(command, self.commands.get(ANY))) is None:
+            return 0
+
+        with self.lock:
+            if (slot := self.slots.get(key)) is None:
+                slot = self.slots[key] = self.allocate(now)
+
+            bucket = slot + i
+            rate, burst = self.rates[i], self.bursts[i]
+            tokens = min(burst, self.tokens[bucket] + (now - self.stamps[bucket]) * rate)
+            self.stamps[bucket] = now
+
+            if tokens >= 1:
+                self.tokens[bucket] = tokens - 1
+                return 0
+            self.tokens[bucket] = tokens
+            return (1 - tokens) / rate
+
+    def allocate(self, now: float) -> int:
+        if len(self.slots) >= self.max_keys:
+            self.sweep(now)
+
+        if self.free:
+            slot = self.free.pop()
+        else:
+            slot = len(self.tokens)
+            self.tokens.extend([0.0] * len(self.commands))
+            self.stamps.extend([0.0] * len(self.commands))
+
+        for i, burst in enumerate(self.bursts):
+            self.tokens[slot + i] = burst
+            self.stamps[slot + i] = now
+        return slot
+
+    def forget(self, key) -> None:
+        with self.lock:
+            if (slot := self.slots.pop(key, None)) is not None:
+                self.free.append(slot)
+
+    def sweep(self, now: float) -> None:
+        """
+        Drop the keys whose buckets are all full again, they are the same as new keys.
+        Must be called while holding the lock.
+        """
+        for key, slot in list(self.slots.items()):
+            if all(self.tokens[slot + i] + (now - self.stamps[slot + i]) * rate >= burst
+                   for i, (rate, burst) in enumerate(zip(self.rates, self.bursts))):
+                del self.slots[key]
+                self.free.append(slot)
+
+
+class RateLimits:
+    """
+    The rate limiters of all the scopes, and how many requests they rejected.
+    """
+
+    def __init__(self, limits: dict = None):
+        self.configure(limits or DEFAULT_LIMITS)
+
+    def configure(self, limits: dict) -> None:
+        self.limits = limits
+        self.clients = RateLimiter(limits.get('client', {}))
+        self.addresses = RateLimiter(limits.get('address', {}))
+        self.rejected = Counter()  # Command -> rejected requests.
+
+    def check(self, client, command: str) -> float:
+        """
+        Returns 0 when the client may run the command now, or the seconds it should wait.
+        """
+        now = time.monotonic()
+        retry_after = self.clients.take(id(client), command, now)
+        if not retry_after and client.address is not None:
+            retry_after = self.addresses.take(client.address, command, now)
+
+        if retry_after:
+            self.rejected[command] += 1
+        return retry_after
+
+    def forget(self, client) -> None:
+        # Addresses are not forgotten, other clients may share them.
+        self.clients.forget(id(client))
+
+    def stats(self) -> dict:
+        return {'rejected': dict(self.rejected), 'clients': len(self.clients.slots),
+                'addresses': len(self.addresses.slots)}
+
+
+def parse_limit(value: str) -> tuple[str, str, tuple[float, float]]:
+    """
+    Parse a limit given as scope:command=rate/burst, e.g. client:send_message=5/20.
+    """
+    scope, rest = value.split(":", 1)
+    command, limit = rest.split("=", 1)
+    rate, burst = limit.split("/", 1)
+    if scope not in DEFAULT_LIMITS:
+        raise ValueError(f"Unknown scope {scope}")
+    return scope, command, (float(rate), float(burst))
+
+
+limits = RateLimits()
@@ -1,12 +1,35 @@
+import math
 import os
-import random
 import re
-from _thread import start_new_thread
+import time
 from email.headerregistry import Address
 from email.message import EmailMessage
 
-from client import Client
-from utils import send_email, encrypt, mutex, QueryExecutor
+import metrics
+from client import Client, lagging_clients
+from code_store import CodeStore
+from email_outbox import EmailOutbox
+from heartbeats import reaper
+from message_log import MessageLog
+from passwords import hasher
+from presence import Presence
+from profiling import profiler
+from rate_limit import limits
+from smart_socket import CODECS, COMPRESSIONS, FEATURES, FRAMED, LEGACY, PROTOCOL_VERSION, JsonCodec
+from tracing import tracer
+from user_cache import UserCache
+from utils import encrypt, mutex, QueryExecutor
+
+# Rate limited requests of the authentication forms are answered in the shape of the command's own answer,
+# with the error on a field of the form. The other commands get a {'type': "error"} answer.
+REJECTIONS = {
+    "login": lambda error: {'errors': {'username': error}},
+    "signup": lambda error: {'username': error},
+    "activate_user": lambda error: {'errors': {'code': error}},
+    "reset_password": lambda error: {'password': error},
+    "send_validation_email": lambda error: f"ERROR: {error}.",
+    "username_exists": lambda error: f"ERROR: {error}.",
+}
 
 
 # Require login before using this command.
@@ -21,15 +44,33 @@ def login_required(function):
     return inner
 
 
+# Allow only the admins to use this command.
+def admin_required(function):
+    def inner(*args, **kwargs):
+        self: RequestsHandler = args[0]
+        if not self.client.is_authenticated or self.client.username not in self.admins:
+            return "ERROR: Only admins may use this command."
+
+        return function(*args, **kwargs)
+
+    return inner
+
+
 class RequestsHandler:
-    validation_codes = {}
+    database = "database/database.db"
+    rehashing = set()  # Users whose outdated password hash is being replaced.
+    admins = set()  # Users allowed to run the stats, profile and trace commands.
 
-    def __init__(self, client: Client, clients: list[Client]):
+    def __init__(self, client: Client, clients: Presence):
         self.client = client
         self.clients = clients
 
-        # Opening SQL connection.
-        self.execute_query = QueryExecutor("database/database.db")
+        # Using the SQL connections shared by all the handlers.
+        self.execute_query = QueryExecutor.shared(self.database)
+        self.users = UserCache.shared(self.database)
+        self.messages = MessageLog.shared(self.database)
+        self.emails = EmailOutbox.shared(self.database)
+        self.codes = CodeStore.shared(self.database)
 
         self.rooms = ["Sports", "Gaming", "Food"]  # Available rooms.
 
@@ -48,10 +89,102 @@ class RequestsHandler:
             "reset_password": self.reset_password,
             "username_exists": self.username_exists,
             "get_rooms": self.get_rooms,
+            "get_history": self.get_history,
+            "hello": self.hello,
+            "batch": self.batch,
+            "stats": self.stats,
+            "profile": self.profile,
+            "trace": self.trace,
+            "pong": self.pong,
         }
 
-        # Running selected command.
-        return supported.get(command, lambda **kwargs: f"ERROR: Unknown command {command}.")(**params)
+        function = supported.get(command, lambda **kwargs: f"ERROR: Unknown command {command}.")
+        # Unknown commands share a label, so clients can't create new metrics or rate limit counters.
+        label = command if command in supported else "unknown"
+
+        # Rejecting the request when the client (or its address) sends this command too often.
+        if retry_after := limits.check(self.client, label):
+            function = lambda **kwargs: self.rejection(label, retry_after)
+
+        if 'id' not in request:
+            # Running selected command.
+            return self.run(label, function, params)
+
+        # The response is matched to its request by the client, even when there is nothing to return.
+        try:
+            return {'type': "response", 'id': request['id'], 'data': self.run(label, function, params)}
+        except Exception as e:
+            return {'type': "response", 'id': request['id'], 'error': f"{type(e).__name__}: {e}"}
+
+    @staticmethod
+    def rejection(label: str, retry_after: float):
+        """
+        The answer of a rate limited request.
+        """
+        if label in REJECTIONS:
+            return REJECTIONS[label](f"Too many attempts, wait {math.ceil(retry_after)}s")
+        return {'type': "error", 'retry_after': round(retry_after, 3),
+                'errors': {'rate_limit': f"Too many {label} requests, try again later"}}
+
+    def run(self, label: str, function, params: dict):
+        """
+        Run a command, counting it and its errors and measuring how long it took.
+        """
+        if (trace := self.client.trace) is not None:
+            # The commands of a batch are part of its trace.
+            self.client.trace = None
+            trace.command = label
+            return tracer.run(trace, lambda: self.run(label, function, params))
+
+        start = time.perf_counter()
+        try:
+            result = function(**params)
+        except Exception:
+            metrics.request_errors.inc(label=label)
+            raise
+        else:
+            if isinstance(result, str) and result.startswith("ERROR:"):
+                metrics.request_errors.inc(label=label)
+            return result
+        finally:
+            metrics.requests.inc(label=label)
+            metrics.request_seconds.observe(time.perf_counter() - start, label)
+
+    def hello(self, **kwargs):
+        version = min(kwargs.get('version', LEGACY), PROTOCOL_VERSION)
+        # Choosing the first codec in the client's preference that the server supports.
+        codecs = [codec for codec in kwargs.get('codecs', []) if codec in CODECS] if version == FRAMED else []
+        codec = codecs[0] if codecs else JsonCodec.name
+        compressions = [c for c in kwargs.get('compressions', []) if c in COMPRESSIONS] if version == FRAMED else []
+        compression = compressions[0] if compressions else None
+        features = [feature for feature in kwargs.get('features', []) if feature in FEATURES]
+
+        # The answer is sent using the framing the client used to ask,
+        # both sides switch right after it was written.
+        self.client.send({'version': version, 'codec': codec, 'compression': compression, 'features': features})
+        self.client.flush()
+        self.client.upgrade(version, codec, compression)
+        self.client.features = tuple(features)
+        if "heartbeat" in features:
+            reaper.add(self.client)
+
+    def pong(self, **kwargs):
+        # Answer of a heartbeat, receiving it already marked the client as alive.
+        pass
+
+    def batch(self, **kwargs):
+        """
+        Run the commands in order and return all their results in one response.
+        A failing command does not stop the others, its error is returned in its place.
+        """
+        results = []
+        for request in kwargs.get('commands', []):
+            try:
+                results.append({'data': self.handle({'command': request.get('command'),
+                                                     'parameters': request.get('parameters', {})})})
+            except Exception as e:
+                results.append({'error': f"{type(e).__name__}: {e}"})
+        return results
 
     @mutex
     def login(self, **kwargs):
@@ -59,27 +192,39 @@ class RequestsHandler:
         password = kwargs.get('password')
 
         # If username exists.
-        if user := self.execute_query("SELECT password, isActive, name FROM tblUsers WHERE username=?",
-                                      [username]):
+        if user := self.users.get(username):
             # Getting the user's details.
-            encrypted_password, active, name = user[0]
+            encrypted_password, active, name = user['password'], user['isActive'], user['name']
             # Validating password.
-            if encrypted_password == encrypt(password):
+            valid, outdated = hasher.verify(password, encrypted_password)
+            if valid:
+                if outdated and username not in RequestsHandler.rehashing:
+                    # Upgrading the hash in the background, the user doesn't wait for it.
+                    RequestsHandler.rehashing.add(username)
+                    hasher.submit(self.rehash, username, password, encrypted_password)
                 # Verifying that the user was activated.
                 if not active:
                     return {'errors': {'username': 'Username is not active'}}
-                # Checking if the client is already connected.
-                for client in self.clients:
-                    if client.is_authenticated and client.username == username:
-                        return {'errors': {'username': 'You are already connected via another client'}}
-
-                # Logging in.
-                self.client.username = username
-                self.client.name = name
+                # Logging in, unless the client is already connected.
+                if not self.clients.login(self.client, username, name):
+                    return {'errors': {'username': 'You are already connected via another client'}}
                 return {'errors': {}, 'data': {'name': name}}
             return {'errors': {'password': 'Incorrect password'}}
         return {'errors': {'username': 'Username does not exist'}}
 
+    def rehash(self, username: str, password: str, encrypted_password: str):
+        """
+        Replace the outdated hash of a user who just logged in, unless the password was changed meanwhile.
+        Runs on the hasher's pool.
+        """
+        try:
+            new_password = hasher.compute(password, hasher.salt(), hasher.iterations)
+            self.execute_query("UPDATE tblUsers SET password=? WHERE username=? AND password=?",
+                               [new_password, username, encrypted_password])
+            self.users.invalidate(username)
+        finally:
+            RequestsHandler.rehashing.discard(username)
+
     @login_required
     def send_message(self, **kwargs):
         msg = kwargs.get("message")
@@ -92,52 +237,88 @@ class RequestsHandler:
         if not self.client.room or not msg:
             return
 
-        for client in self.clients:
-            if client.is_authenticated and client.room == self.client.room:
-                try:
-                    # Sending the message.
-                    client.send({"type": "message",
-                                 "data": {"message": msg, "username": self.client.username, "name": self.client.name}})
-                except:
-                    self.remove_client(client)
+        # Saving the message, without waiting for the disk.
+        self.messages.append(self.client.room, self.client.username, self.client.name, msg)
+
+        # Sending the message.
+        self.clients.send_to_room(self.client.room,
+                                  {"type": "message", "data": {"message": msg, "username": self.client.username,
+                                                               "name": self.client.name}})
 
     @mutex
     def remove_client(self, client: Client):
-        if client in self.clients:
-            self.clients.remove(client)
+        limits.forget(client)
+        reaper.remove(client)
+        if self.clients.remove(client) and client.is_authenticated:
             # Notifying that the client is no longer connected.
             self.notify_all_client_entered(client, room="None")
 
     def notify_all_client_entered(self, client: Client, **kwargs):
         room = kwargs.get("room")
 
-        for c in self.clients:
-            if c.is_authenticated:
-                try:
-                    c.send({"type": "client_entered", "data": {"room": room, "username": client.username}})
-                except:
-                    self.remove_client(client)
+        self.clients.send_to_all({"type": "client_entered", "data": {"room": room, "username": client.username}},
+                                 key=("client_entered", client.username))
 
     @login_required
     def enter_room(self, **kwargs):
         room = kwargs.get("room")
 
         if room in self.rooms:
-            self.client.room = room
+            self.clients.enter_room(self.client, room)
             self.notify_all_client_entered(self.client, room=room)
 
     @login_required
     def get_online(self):
-        result = []
-        for client in self.clients:
-            if client.is_authenticated and client.room is not None:
-                result.append({"room": client.room, "username": client.username})
-        return result
+        return self.clients.online()
 
     @login_required
     def get_rooms(self):
         return self.rooms
 
+    @login_required
+    def get_history(self, **kwargs):
+        """
+        A page of the room's messages, oldest first.
+        The next (older) page is the one before the id of the first message.
+        """
+        room = kwargs.get("room", self.client.room)
+        before = kwargs.get("before")
+        limit = max(1, min(int(kwargs.get("limit", 50)), 200))
+
+        if room not in self.rooms:
+            return f"ERROR: Unknown room {room}."
+
+        return self.messages.history(room, before, limit)
+
+    @admin_required
+    def stats(self, **kwargs):
+        """
+        The server's metrics and the clients with the longest outbound queues.
+        """
+        return {'metrics': metrics.registry.snapshot(), 'lagging_clients': lagging_clients(self.clients)[:20],
+                'profiler': profiler.stats(), 'tracer': tracer.stats()}
+
+    @admin_required
+    def profile(self, **kwargs):
+        """
+        Sample the stacks of the server's threads for a number of seconds, returns the path of the results.
+        """
+        try:
+            return {'path': profiler.start(kwargs.get('seconds'))}
+        except RuntimeError as e:
+            return f"ERROR: {e}."
+
+    @admin_required
+    def trace(self, **kwargs):
+        """
+        Turn tracing of the requests on (optionally for a number of seconds) or off.
+        """
+        if kwargs.get('enabled', True):
+            tracer.enable(kwargs.get('seconds'))
+        else:
+            tracer.disable()
+        return tracer.stats()
+
     @mutex
     def signup(self, **kwargs):
         username = kwargs.get('username')
@@ -158,7 +339,7 @@ class RequestsHandler:
         if not re.fullmatch("([A-Za-z]+ ?)*", name):
             errors['name'] = "Invalid name"  # Client forcing this regex.
 
-        if self.execute_query("SELECT username from tblUsers WHERE username=?", [username]):
+        if self.users.get(username):
             errors['username'] = "Username already in use"
 
         self.validate_password(errors, password, password_confirmation)
@@ -176,25 +357,20 @@ class RequestsHandler:
             errors['phone_number'] = "Phone number must contain exactly 10 digits"
 
         if not errors:
-            encrypted_password = encrypt(password)
+            encrypted_password = hasher.hash(password)
             self.execute_query("INSERT INTO tblUsers VALUES (?, ?, ?, ?, 0, ?)",
                                [username, name, email, encrypted_password, phone_number])
+            self.users.put(username, {'name': name, 'email': email, 'password': encrypted_password, 'isActive': 0})
         return errors
 
-    @staticmethod
-    def validate_code(username, code):
-        assert code == RequestsHandler.validation_codes[username], f"Wrong validation code {code}"
-        # Invalidating the validation code so that it will only be used ones.
-        del RequestsHandler.validation_codes[username]
-
     def send_validation_email(self, **kwargs):
         username = kwargs.get('username')
 
-        name, email_address = \
-            self.execute_query("SELECT name, email FROM tblUsers WHERE username=?", [username])[0]
+        user = self.users.get(username)
+        assert user is not None, f"Unknown user {username}"
+        name, email_address = user['name'], user['email']
         # Generating the code.
-        code = RequestsHandler.validation_codes.get(username, str(random.randint(100000, 999999)))
-        RequestsHandler.validation_codes[username] = code
+        code = self.codes.issue(username)
 
         email = EmailMessage()
         email['Subject'] = "Email Validation - Chat Application"
@@ -206,8 +382,8 @@ class RequestsHandler:
               f"please enter {code} in the email validation window."
         email.set_content(msg)
 
-        # Sending the email.
-        start_new_thread(send_email, (email,))
+        # Sending the email, in the background.
+        self.emails.send(email)
 
         # Returning the hashed code.
         # This is not necessary but used by the client to quickly validate the code.
@@ -234,21 +410,33 @@ class RequestsHandler:
         self.validate_password(errors, password, password_confirmation)
 
         if not errors:
-            self.validate_code(username, code)
-            self.execute_query("UPDATE tblUsers SET password=? WHERE username=?", [encrypt(password), username])
+            try:
+                self.codes.validate(username, code)
+            except AssertionError as e:
+                # The code expired, or was guessed too often, the client asks for a new one.
+                return {'code': str(e)}
+            encrypted_password = hasher.hash(password)
+            self.execute_query("UPDATE tblUsers SET password=? WHERE username=?", [encrypted_password, username])
+            self.users.invalidate(username)
 
         return errors
 
     def username_exists(self, **kwargs):
         username = kwargs.get('username')
 
-        return len(self.execute_query("SELECT username FROM tblUsers WHERE username=?", [username])) > 0
+        return self.users.get(username) is not None
 
     def activate_user(self, **kwargs):
         username = kwargs.get('username')
         code = kwargs.get('code')  # Validation code generated by send_validation_email.
 
-        self.validate_code(username, code)
+        try:
+            self.codes.validate(username, code)
+        except AssertionError as e:
+            # The code expired, or was guessed too often, the client asks for a new one.
+            return {'errors': {'code': str(e)}}
 
         # Code is valid, activating the user.
         self.execute_query("UPDATE tblUsers SET isActive=1 WHERE username=?", [username])
+        self.users.invalidate(username)
+        return {'errors': {}}
@@ -0,0 +1,62 @@
+from collections import deque
+from threading import Lock
+
+
+class BacklogEntry:
+    __slots__ = ("event", "payloads", "size")
+
+    def __init__(self, event: dict):
+        self.event = event
+        self.payloads = {}  # Codec -> payload, encoded when a newcomer first needs it.
+        # The text of the message, until payloads are added.
+        self.size = sum(len(value) for value in event["data"].values() if isinstance(value, str))
+
+
+class RoomBacklog:
+    """
+    The last messages of a room, kept so that a client entering the room gets some context without reading the database.
+    A message is encoded for a codec when the first newcomer using that codec enters the room,
+    the same payload is then queued to every later newcomer.
+    Bounded both by number of messages and by the bytes of their text and payloads,
+    the oldest messages are dropped first.
+    """
+    max_messages = 50
+    max_bytes = 64 * 1024
+
+    def __init__(self, room: str):
+        self.room = room
+        self.lock = Lock()
+        self.entries = deque()  # Oldest first.
+        self.size = 0  # Bytes of all the entries.
+
+    def append(self, data: dict) -> None:
+        entry = BacklogEntry({"type": "backlog", "data": {**data, "room": self.room}})
+        with self.lock:
+            self.entries.append(entry)
+            self.size += entry.size
+            self.trim()
+
+    def trim(self) -> None:
+        while self.entries and (len(self.entries) > self.max_messages or self.size > self.max_bytes):
+            self.size -= self.entries.popleft().size
+
+    def payload(self, entry: BacklogEntry, codec) -> bytes:
+        if (payload := entry.payloads.get(codec)) is None:
+            payload = entry.payloads[codec] = codec.encode(entry.event)
+            entry.size += len(payload)
+            self.size += len(payload)
+        return payload
+
+    def send(self, client) -> None:
+        """
+        Queue the backlog to the client, as backlog events in their original order.
+        """
+        with self.lock:
+            payloads = [self.payload(entry, client.codec) for entry in self.entries]
+            self.trim()
+
+        for payload in payloads:
+            client.enqueue(payload)
+
+    def stats(self) -> dict:
+        return {'room': self.room, 'messages': len(self.entries), 'bytes': self.size}
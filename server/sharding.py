@@ -0,0 +1,200 @@
+"""
+Multi-process server: several worker processes accept connections on the same port,
+and share room messages and presence events over a local Unix socket broker.
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from _thread import start_new_thread
+from threading import Lock
+
+from client import Client
+from presence import Presence
+from smart_socket import FRAMED, Socket
+
+BUS_PATH = "chat-bus-{port}.sock"
+
+
+class Broker:
+    """
+    Relays every event published by a worker to all the other workers.
+    Remembers who is online so that workers which connect late (or restart) get the current presence.
+    """
+
+    def __init__(self, path: str):
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+
+        self.lock = Lock()
+        self.workers = []
+        self.presence = {}  # Username -> (worker, last presence event).
+
+    def run(self) -> None:
+        while True:
+            sock, _ = self.server.accept()
+            worker = Socket(sock)
+            worker.upgrade(FRAMED)
+
+            with self.lock:
+                for _, event in self.presence.values():
+                    worker.send(event)
+                self.workers.append(worker)
+            start_new_thread(self.relay, (worker,))
+
+    def relay(self, worker: Socket) -> None:
+        while True:
+            try:
+                event = worker.receive()
+            except (ConnectionError, OSError):
+                break
+
+            with self.lock:
+                if event['kind'] == "presence":
+                    if event['online']:
+                        self.presence[event['username']] = worker, event
+                    else:
+                        self.presence.pop(event['username'], None)
+                self.publish(event, worker)
+
+        with self.lock:
+            self.workers.remove(worker)
+            # The users of a dead worker are no longer online.
+            for username, (owner, event) in list(self.presence.items()):
+                if owner is worker:
+                    del self.presence[username]
+                    self.publish({'kind': "presence", 'username': username, 'room': None, 'online': False}, worker)
+                    self.publish({'kind': "all", 'key': ["client_entered", username],
+                                  'data': {"type": "client_entered", "data": {"room": "None", "username": username}}},
+                                 worker)
+
+    def publish(self, event, sender: Socket) -> None:
+        """
+        Must be called while holding the lock.
+        """
+        # Every bus connection uses the same framing and codec, the event is encoded once.
+        frame = sender.frame(sender.encode(event))
+        for worker in self.workers:
+            if worker is not sender:
+                try:
+                    with worker.send_lock:
+                        worker.socket.sendall(frame)
+                except OSError:
+                    pass
+
+
+class ShardedPresence(Presence):
+    """
+    Presence of a single worker, which also knows about the users connected to the other workers.
+    Local changes and fan-outs are published to the broker, remote fan-outs are delivered to the local clients.
+    """
+
+    def __init__(self, path: str, worker: int = 0):
+        super(ShardedPresence, self).__init__()
+        self.worker = worker
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        self.bus = Socket(sock)
+        self.bus.upgrade(FRAMED)
+
+        self.remote = {}  # Username -> room (None when not in a room) of the users of other workers.
+        self.user_listeners = []  # Called with the username of every user changed by another worker.
+        start_new_thread(self.listen, ())
+
+    def publish_presence(self, client: Client, online: bool = True) -> None:
+        self.bus.send({'kind': "presence", 'username': client.username, 'room': client.room, 'online': online})
+
+    def publish_user_change(self, username: str) -> None:
+        self.bus.send({'kind': "user", 'username': username})
+
+    def login(self, client: Client, username: str, name: str) -> bool:
+        # Best effort: two workers may still accept the same user at the very same time.
+        if username in self.remote or not super(ShardedPresence, self).login(client, username, name):
+            return False
+
+        self.publish_presence(client)
+        return True
+
+    def enter_room(self, client: Client, room: str) -> None:
+        super(ShardedPresence, self).enter_room(client, room)
+        self.publish_presence(client)
+
+    def remove(self, client: Client) -> bool:
+        if removed := super(ShardedPresence, self).remove(client):
+            if client.is_authenticated and self.by_username.get(client.username) is None:
+                self.publish_presence(client, online=False)
+        return removed
+
+    def online(self) -> list[dict]:
+        remote = [{"room": room, "username": username} for username, room in list(self.remote.items())
+                  if room is not None]
+        return super(ShardedPresence, self).online() + remote
+
+    def send_to_room(self, room: str, data) -> None:
+        super(ShardedPresence, self).send_to_room(room, data)
+        self.bus.send({'kind': "room", 'room': room, 'data': data})
+
+    def send_to_all(self, data, key=None) -> None:
+        super(ShardedPresence, self).send_to_all(data, key)
+        self.bus.send({'kind': "all", 'key': key, 'data': data})
+
+    def listen(self) -> None:
+        while True:
+            try:
+                event = self.bus.receive()
+            except (ConnectionError, OSError):
+                # Without the broker this worker's rooms are no longer shared, the whole server is going down.
+                os._exit(1)
+
+            if event['kind'] == "presence":
+                if event['online']:
+                    self.remote[event['username']] = event['room']
+                else:
+                    self.remote.pop(event['username'], None)
+            elif event['kind'] == "room":
+                Presence.send_to_room(self, event['room'], event['data'])
+            elif event['kind'] == "all":
+                key = tuple(event['key']) if event['key'] is not None else None
+                Presence.send_to_all(self, event['data'], key)
+            elif event['kind'] == "user":
+                for listener in self.user_listeners:
+                    listener(event['username'])
+
+
+def run(processes: int, listen, serve, path: str) -> None:
+    """
+    Start the broker and the worker processes.
+    listen(reuse_port) creates a listening socket, serve(listener, presence) runs a worker's server.
+    When SO_REUSEPORT is not available the workers accept from a single socket created before forking.
+    """
+    context = multiprocessing.get_context("fork")
+    broker = Broker(path)
+    shared = None if hasattr(socket, "SO_REUSEPORT") else listen(False)
+
+    workers = [context.Process(target=work, args=(listen, serve, path, shared, i), daemon=True)
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def stop(signum, frame):
+        for w in workers:
+            w.terminate()
+        os.remove(path)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+
+    # Starting the broker's thread only after forking.
+    start_new_thread(broker.run, ())
+    for worker in workers:
+        worker.join()
+
+
+def work(listen, serve, path: str, listener: socket.socket = None, worker: int = 0) -> None:
+    serve(listener or listen(True), ShardedPresence(path, worker))
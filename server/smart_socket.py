@@ -1,29 +1,472 @@
+import itertools
 import json
+import queue
 import socket
+import struct
+import time
+import zlib
+from _thread import start_new_thread
+from collections import deque
+from concurrent.futures import Future
+from threading import Lock
+
+# Protocol versions:
+# 1 - every message is followed by a <done> delimiter.
+# 2 - every message is preceded by a fixed size header holding its flags and length.
+LEGACY = 1
+FRAMED = 2
+PROTOCOL_VERSION = FRAMED
+
+DELIMITER = b"<done>"
+HEADER = struct.Struct("!BI")  # Flags, payload length.
+MAX_FRAME_SIZE = 2 ** 24
+RECEIVE_SIZE = 65536
+
+# Frame flags.
+COMPRESSED = 0x01
+
+COMPRESSIONS = ("zlib",)  # Supported compression methods.
+# Supported protocol extensions:
+# ids - requests may carry an id, their response is sent as {"type": "response", "id": ..., "data": ...}.
+# batch - the batch command runs a list of commands and returns all their results in one response.
+FEATURES = ("ids", "batch", "heartbeat")
+PING = "ping"  # Heartbeat sent by the server to clients that negotiated it, answered by the pong command.
+PONG = "pong"
+COMPRESSION_THRESHOLD = 1024  # Smaller payloads are sent as is.
+
+
+class CompressionStats:
+    """
+    Counters used to tune the compression threshold.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.frames = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_time = 0.0
+        self.decompressed_frames = 0
+        self.decompress_time = 0.0
+
+    def compressed(self, raw_bytes: int, compressed_bytes: int, seconds: float) -> None:
+        with self.lock:
+            self.frames += 1
+            self.raw_bytes += raw_bytes
+            self.compressed_bytes += compressed_bytes
+            self.compress_time += seconds
+
+    def decompressed(self, seconds: float) -> None:
+        with self.lock:
+            self.decompressed_frames += 1
+            self.decompress_time += seconds
+
+    @property
+    def ratio(self) -> float:
+        return self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 1.0
+
+    def as_dict(self) -> dict:
+        return {'frames': self.frames, 'raw_bytes': self.raw_bytes, 'compressed_bytes': self.compressed_bytes,
+                'ratio': self.ratio, 'compress_seconds': self.compress_time,
+                'decompressed_frames': self.decompressed_frames, 'decompress_seconds': self.decompress_time}
+
+
+# Totals of all the sockets in this process.
+compression_stats = CompressionStats()
+
+
+class JsonCodec:
+    name = "json"
+
+    @staticmethod
+    def encode(data) -> bytes:
+        return json.dumps(data).encode()
+
+    @staticmethod
+    def decode(payload: bytes):
+        return json.loads(payload)
+
+
+class CompactCodec:
+    """
+    Binary encoding of json-like objects.
+    Keys and values that appear in every event (field names, event types and commands) are sent as a single byte.
+    It saves bandwidth only: encoding in Python costs more CPU than the C json module (see benchmarks.codecs),
+    so it is meant for slow links, not for busy servers.
+    """
+    name = "compact"
+
+    # Never reorder, only append: both sides must agree on the index of every tag.
+    TAGS = ("type", "data", "message", "username", "name", "room", "command", "parameters", "errors", "id",
+            "password", "password_confirmation", "email", "phone_number", "code", "version", "codec", "codecs",
+            "client_entered", "login", "signup", "send_message", "enter_room", "get_online", "get_rooms",
+            "activate_user", "send_validation_email", "reset_password", "username_exists", "hello", "None",
+            "Sports", "Gaming", "Food")
+    TAG_INDEXES = {tag: index for index, tag in enumerate(TAGS)}
+
+    NONE, FALSE, TRUE, INT8, INT32, INT64, FLOAT, STR8, STR32, LIST8, LIST32, DICT8, DICT32 = range(13)
+    TAG = 0x80  # Known strings are sent as TAG | index.
+
+    INT8_STRUCT = struct.Struct("!Bb")
+    INT32_STRUCT = struct.Struct("!Bi")
+    INT64_STRUCT = struct.Struct("!Bq")
+    FLOAT_STRUCT = struct.Struct("!Bd")
+    SIZE8_STRUCT = struct.Struct("!BB")
+    SIZE32_STRUCT = struct.Struct("!BI")
+
+    @classmethod
+    def encode(cls, data) -> bytes:
+        chunks = []
+        cls._encode(data, chunks)
+        return b"".join(chunks)
+
+    @classmethod
+    def _encode(cls, value, chunks: list) -> None:
+        if isinstance(value, str):
+            if (index := cls.TAG_INDEXES.get(value)) is not None:
+                chunks.append(bytes((cls.TAG | index,)))
+                return
+            value = value.encode()
+            if len(value) < 256:
+                chunks.append(cls.SIZE8_STRUCT.pack(cls.STR8, len(value)))
+            else:
+                chunks.append(cls.SIZE32_STRUCT.pack(cls.STR32, len(value)))
+            chunks.append(value)
+        elif isinstance(value, dict):
+            if len(value) < 256:
+                chunks.append(cls.SIZE8_STRUCT.pack(cls.DICT8, len(value)))
+            else:
+                chunks.append(cls.SIZE32_STRUCT.pack(cls.DICT32, len(value)))
+            for key, item in value.items():
+                cls._encode(key, chunks)
+                cls._encode(item, chunks)
+        elif isinstance(value, (list, tuple)):
+            if len(value) < 256:
+                chunks.append(cls.SIZE8_STRUCT.pack(cls.LIST8, len(value)))
+            else:
+                chunks.append(cls.SIZE32_STRUCT.pack(cls.LIST32, len(value)))
+            for item in value:
+                cls._encode(item, chunks)
+        elif value is None:
+            chunks.append(bytes((cls.NONE,)))
+        elif value is True:
+            chunks.append(bytes((cls.TRUE,)))
+        elif value is False:
+            chunks.append(bytes((cls.FALSE,)))
+        elif isinstance(value, int):
+            if -128 <= value < 128:
+                chunks.append(cls.INT8_STRUCT.pack(cls.INT8, value))
+            elif -2 ** 31 <= value < 2 ** 31:
+                chunks.append(cls.INT32_STRUCT.pack(cls.INT32, value))
+            else:
+                chunks.append(cls.INT64_STRUCT.pack(cls.INT64, value))
+        elif isinstance(value, float):
+            chunks.append(cls.FLOAT_STRUCT.pack(cls.FLOAT, value))
+        else:
+            raise TypeError(f"Object of type {type(value).__name__} is not serializable")
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        value, position = cls._decode(payload, 0)
+        return value
+
+    @classmethod
+    def _decode(cls, payload: bytes, position: int):
+        kind = payload[position]
+        position += 1
+
+        if kind & cls.TAG:
+            return cls.TAGS[kind & ~cls.TAG], position
+        if kind == cls.STR8 or kind == cls.STR32:
+            if kind == cls.STR8:
+                size, position = payload[position], position + 1
+            else:
+                size, position = struct.unpack_from("!I", payload, position)[0], position + 4
+            return payload[position:position + size].decode(), position + size
+        if kind == cls.DICT8 or kind == cls.DICT32 or kind == cls.LIST8 or kind == cls.LIST32:
+            if kind == cls.DICT8 or kind == cls.LIST8:
+                size, position = payload[position], position + 1
+            else:
+                size, position = struct.unpack_from("!I", payload, position)[0], position + 4
+            if kind == cls.LIST8 or kind == cls.LIST32:
+                result = []
+                for _ in range(size):
+                    item, position = cls._decode(payload, position)
+                    result.append(item)
+                return result, position
+            result = {}
+            for _ in range(size):
+                key, position = cls._decode(payload, position)
+                result[key], position = cls._decode(payload, position)
+            return result, position
+        if kind == cls.NONE:
+            return None, position
+        if kind == cls.TRUE:
+            return True, position
+        if kind == cls.FALSE:
+            return False, position
+        if kind == cls.INT8:
+            return struct.unpack_from("!b", payload, position)[0], position + 1
+        if kind == cls.INT32:
+            return struct.unpack_from("!i", payload, position)[0], position + 4
+        if kind == cls.INT64:
+            return struct.unpack_from("!q", payload, position)[0], position + 8
+        if kind == cls.FLOAT:
+            return struct.unpack_from("!d", payload, position)[0], position + 8
+        raise ValueError(f"Unknown type {kind} at position {position - 1}")
+
+
+# Supported codecs, json is the default.
+CODECS = {codec.name: codec for codec in (JsonCodec, CompactCodec)}
+
+
+class LegacyDecoder:
+    """
+    Splits the incoming stream on the <done> delimiter.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.searched = 0  # Bytes of the buffer that were already searched for a delimiter.
+
+    def feed(self, data) -> list[tuple[int, bytes]]:
+        self.buffer += data
+
+        frames = []
+        start = 0
+        # The delimiter may have been split between two reads.
+        position = max(self.searched - len(DELIMITER) + 1, 0)
+        while (end := self.buffer.find(DELIMITER, position)) != -1:
+            frames.append((0, bytes(self.buffer[start:end])))
+            start = position = end + len(DELIMITER)
+
+        del self.buffer[:start]
+        self.searched = len(self.buffer)
+        return frames
+
+
+class FrameDecoder:
+    """
+    Splits the incoming stream into length-prefixed frames.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data) -> list[tuple[int, bytes]]:
+        self.buffer += data
+
+        frames = []
+        start = 0
+        with memoryview(self.buffer) as view:
+            while len(view) - start >= HEADER.size:
+                flags, length = HEADER.unpack_from(view, start)
+                if length > MAX_FRAME_SIZE:
+                    raise ConnectionError(f"Frame of {length} bytes is too large.")
+                end = start + HEADER.size + length
+                if end > len(view):
+                    break
+                frames.append((flags, bytes(view[start + HEADER.size:end])))
+                start = end
+
+        del self.buffer[:start]
+        return frames
 
 
 class Socket:
     """
     Socket enhancement to enable sending unlimited-size messages and using the json module.
     """
+    compression_threshold = COMPRESSION_THRESHOLD
 
     def __init__(self, sock: socket.socket):
         self.socket = sock
+        self.send_lock = Lock()  # Frames must be compressed and written in the same order.
+
+        self.version = LEGACY
+        self.codec = JsonCodec
+        self.decoder = LegacyDecoder()
+        self.frames = deque()  # Frames that were received but not consumed yet.
+        self.receive_buffer = memoryview(bytearray(RECEIVE_SIZE))
+
+        # Each direction keeps its own zlib stream for the whole connection,
+        # so keys that repeat in every message are compressed well.
+        self.compression = None
+        self.compressor = None
+        self.decompressor = None
+        self.compression_stats = CompressionStats()
+
+        # Protocol extensions both sides agreed on.
+        self.features = ()
+
+        # Requests in flight, when responses and pushes are read by the dispatcher.
+        self.ids = itertools.count(1)
+        self.pending = {}  # Request id -> future.
+        self.pending_lock = Lock()
+        self.error = None  # The error that stopped the dispatcher, no response will come anymore.
+        self.events = None  # Pushes (and the error that stopped the dispatcher).
+
+    def encode(self, data) -> bytes:
+        return self.codec.encode(data)
+
+    def decode(self, payload: bytes):
+        return self.codec.decode(payload)
+
+    def frame(self, payload: bytes, flags: int = 0) -> bytes:
+        if self.version == LEGACY:
+            return payload + DELIMITER
+
+        if self.compressor is not None and len(payload) >= self.compression_threshold:
+            start = time.perf_counter()
+            compressed = self.compressor.compress(payload) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            seconds = time.perf_counter() - start
+
+            self.compression_stats.compressed(len(payload), len(compressed), seconds)
+            compression_stats.compressed(len(payload), len(compressed), seconds)
+            payload, flags = compressed, flags | COMPRESSED
+        return HEADER.pack(flags, len(payload)) + payload
 
     def send(self, data) -> None:
-        data = json.dumps(data).encode()
+        payload = self.encode(data)
+        with self.send_lock:
+            self.socket.sendall(self.frame(payload))
 
-        self.socket.sendall(data)
-        self.socket.send(b"<done>")
+    def feed(self, data) -> None:
+        self.frames.extend(self.decoder.feed(data))
 
     def receive(self):
-        data = b""
-        while not data.endswith(b"<done>"):
-            data += self.socket.recv(1024)
-        data = data[:-6]
+        if self.events is not None:
+            event = self.events.get()
+            if isinstance(event, Exception):
+                # Letting every reader see the error.
+                self.events.put(event)
+                raise event
+            return event
+        return self.read()
+
+    def read(self):
+        while True:
+            while not self.frames:
+                size = self.socket.recv_into(self.receive_buffer)
+                if not size:
+                    raise ConnectionResetError("Connection closed by peer.")
+                self.feed(self.receive_buffer[:size])
+
+            message = self.decode(self.unframe(*self.frames.popleft()))
+            # Heartbeats are answered right away, the application never sees them.
+            if isinstance(message, dict) and message.get('type') == PING:
+                self.send({'command': PONG})
+                continue
+            return message
 
-        return json.loads(data)
+    def unframe(self, flags: int, payload: bytes) -> bytes:
+        if flags & COMPRESSED:
+            start = time.perf_counter()
+            # Bounded, so that a small frame can't expand into gigabytes.
+            payload = self.decompressor.decompress(payload, MAX_FRAME_SIZE)
+            if self.decompressor.unconsumed_tail:
+                raise ConnectionError(f"Compressed frame expands to more than {MAX_FRAME_SIZE} bytes.")
+            seconds = time.perf_counter() - start
+
+            self.compression_stats.decompressed(seconds)
+            compression_stats.decompressed(seconds)
+        return payload
 
     def execute(self, command):
+        if self.events is not None:
+            return self.submit(command).result()
+
         self.send(command)
         return self.receive()
+
+    def submit(self, command) -> Future:
+        """
+        Send a command without waiting for its response.
+        Many commands may be in flight at once, each response resolves the future of its request.
+        """
+        future = Future()
+        if self.events is None:
+            # The server does not support request ids, falling back to a blocking round trip.
+            future.set_result(self.execute(command))
+            return future
+
+        request_id = next(self.ids)
+        with self.pending_lock:
+            # Checked under the lock, so a future is either failed by the dispatcher or never registered.
+            if self.error is not None:
+                raise self.error
+            self.pending[request_id] = future
+        self.send({**command, 'id': request_id})
+        return future
+
+    def start_dispatcher(self) -> None:
+        """
+        Read every incoming message in a background thread.
+        Responses resolve their futures, anything else (pushed events) is returned by receive().
+        """
+        self.events = queue.Queue()
+        start_new_thread(self.dispatch, ())
+
+    def dispatch(self) -> None:
+        while True:
+            try:
+                message = self.read()
+            except Exception as e:
+                with self.pending_lock:
+                    self.error = e
+                    pending, self.pending = self.pending, {}
+                for future in pending.values():
+                    future.set_exception(e)
+                self.events.put(e)
+                return
+
+            if isinstance(message, dict) and message.get('type') == "response":
+                with self.pending_lock:
+                    future = self.pending.pop(message.get('id'), None)
+                if future is None:
+                    continue
+                if 'error' in message:
+                    future.set_exception(Exception(message['error']))
+                else:
+                    future.set_result(message.get('data'))
+            else:
+                self.events.put(message)
+
+    def upgrade(self, version: int, codec: str = JsonCodec.name, compression: str = None) -> None:
+        """
+        Switch the framing, the codec and the compression of both directions.
+        Both sides must switch right after the hello response.
+        """
+        # Binary payloads may contain the <done> delimiter and the legacy framing has no room for flags.
+        self.codec = CODECS[codec] if version == FRAMED else JsonCodec
+        self.compression = compression if version == FRAMED else None
+        if self.compression == "zlib":
+            self.compressor = zlib.compressobj()
+            self.decompressor = zlib.decompressobj()
+
+        if version == self.version:
+            return
+
+        leftover = self.decoder.buffer
+        self.version = version
+        self.decoder = FrameDecoder() if version == FRAMED else LegacyDecoder()
+        self.feed(leftover)
+
+    def negotiate(self, codecs: list[str] = None, compressions: list[str] = COMPRESSIONS,
+                  features: list[str] = FEATURES) -> int:
+        """
+        Offer the newest protocol version, the supported codecs, compression methods and extensions to the server.
+        Servers that do not know the hello command answer with an error and the legacy protocol is kept.
+        """
+        codecs = list(CODECS) if codecs is None else codecs
+        response = self.execute({'command': "hello", 'parameters': {'version': PROTOCOL_VERSION, 'codecs': codecs,
+                                                                   'compressions': list(compressions),
+                                                                   'features': list(features)}})
+
+        if isinstance(response, dict) and response.get('version') in (LEGACY, FRAMED):
+            self.upgrade(response['version'], response.get('codec', JsonCodec.name), response.get('compression'))
+            self.features = tuple(response.get('features', ()))
+
+        if "ids" in self.features:
+            self.start_dispatcher()
+        return self.version
@@ -0,0 +1,137 @@
+"""
+Per-request trace spans (receive, decode, handler, database queries and fan-outs),
+written as JSON lines to a rotating trace file.
+Tracing is off by default, then every hook costs a single attribute check.
+"""
+import json
+import logging
+import random
+import time
+from contextlib import nullcontext
+from logging.handlers import RotatingFileHandler
+from threading import Lock, Timer, local
+
+NO_SPAN = nullcontext()
+
+
+class Trace:
+    __slots__ = ("command", "username", "start", "spans")
+
+    def __init__(self, start: float):
+        self.command = None
+        self.username = None
+        self.start = start  # time.perf_counter() when the first bytes of the request arrived.
+        self.spans = []
+
+    def add(self, name: str, start: float, end: float, **fields) -> None:
+        self.spans.append({'name': name, 'start_ms': round((start - self.start) * 1000, 3),
+                           'ms': round((end - start) * 1000, 3), **fields})
+
+    def as_dict(self) -> dict:
+        return {'time': time.time() - (time.perf_counter() - self.start), 'command': self.command,
+                'username': self.username, 'ms': round((time.perf_counter() - self.start) * 1000, 3),
+                'spans': sorted(self.spans, key=lambda span: span['start_ms'])}
+
+
+class Span:
+    __slots__ = ("trace", "name", "fields", "start")
+
+    def __init__(self, trace: Trace, name: str, fields: dict):
+        self.trace = trace
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.trace.add(self.name, self.start, time.perf_counter(), **self.fields)
+
+
+class Tracer:
+    """
+    Records traces of a sample of the requests while enabled.
+    The trace of a request is bound to the thread handling it, so spans are added without passing it around.
+    """
+    path = "traces.jsonl"
+    max_bytes = 10 * 2 ** 20  # Size of the trace file before it is rotated.
+    backups = 5  # Rotated trace files kept.
+    sample = 1.0  # Fraction of the requests traced.
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = Lock()
+        self.logger = None
+        self.timer = None
+        self.current = local()
+        self.traces = 0
+
+    def enable(self, seconds: float = None) -> None:
+        """
+        Start tracing, for the given number of seconds or until disabled.
+        """
+        with self.lock:
+            if self.logger is None:
+                handler = RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups)
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                self.logger = logging.getLogger("chat.trace")
+                self.logger.propagate = False
+                self.logger.setLevel(logging.INFO)
+                self.logger.addHandler(handler)
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if seconds:
+                self.timer = Timer(seconds, self.disable)
+                self.timer.daemon = True
+                self.timer.start()
+            self.enabled = True
+
+    def disable(self) -> None:
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.enabled = False
+
+    def toggle(self, signum=None, frame=None) -> None:
+        # Also a signal handler.
+        self.disable() if self.enabled else self.enable()
+
+    def begin(self, start: float) -> Trace:
+        """
+        A new trace of a request whose first bytes arrived at start, or None when the request isn't sampled.
+        """
+        if self.sample < 1 and random.random() >= self.sample:
+            return None
+        return Trace(start)
+
+    def span(self, name: str, **fields):
+        """
+        Context manager timing a step of the request traced by the calling thread, if any.
+        """
+        if not self.enabled or (trace := getattr(self.current, 'trace', None)) is None:
+            return NO_SPAN
+        return Span(trace, name, fields)
+
+    def run(self, trace: Trace, function):
+        """
+        Run function as the handler of the traced request, then write the trace.
+        """
+        self.current.trace = trace
+        try:
+            with Span(trace, "handler", {}):
+                return function()
+        finally:
+            self.current.trace = None
+            if self.logger is not None:
+                self.logger.info(json.dumps(trace.as_dict()))
+                self.traces += 1
+
+    def stats(self) -> dict:
+        return {'enabled': self.enabled, 'path': self.path, 'sample': self.sample, 'traces': self.traces}
+
+
+tracer = Tracer()
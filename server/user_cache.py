@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from utils import PerDatabase, QueryExecutor
+
+
+class UserCache(PerDatabase):
+    """
+    Records of tblUsers by username, least recently used first.
+    The handlers invalidate a user's record after every change they commit, and listeners (the other worker
+    processes) are told about it. Records also expire after ttl seconds, as a safety net.
+    A record read while its user was invalidated is not cached, as it may predate the change.
+    Unknown usernames are not cached, so a new user is found as soon as the signup was committed.
+    """
+    max_size = 10000
+    ttl = 60  # Seconds.
+
+    def __init__(self, execute_query: QueryExecutor):
+        self.execute_query = execute_query
+
+        self.lock = Lock()
+        self.records = OrderedDict()  # Username -> (expiry time, record).
+        self.generation = 0  # Invalidations so far.
+        self.listeners = []  # Called with the username of every record invalidated by this process.
+
+        # Cache metrics.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, username: str) -> dict:
+        """
+        The user's record (name, email, password and isActive), None if the user does not exist.
+        """
+        with self.lock:
+            if (entry := self.records.get(username)) is not None:
+                expiry, record = entry
+                if expiry > time.monotonic():
+                    self.records.move_to_end(username)
+                    self.hits += 1
+                    return record
+                del self.records[username]
+            self.misses += 1
+            generation = self.generation
+
+        if not (rows := self.execute_query("SELECT name, email, password, isActive FROM tblUsers WHERE username=?",
+                                           [username])):
+            return None
+
+        name, email, password, active = rows[0]
+        record = {'name': name, 'email': email, 'password': password, 'isActive': active}
+        self.put(username, record, generation)
+        return record
+
+    def put(self, username: str, record: dict, generation: int = None) -> None:
+        """
+        Cache a record, unless it was read at an older generation: a user may have been changed since.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.records[username] = time.monotonic() + self.ttl, record
+            self.records.move_to_end(username)
+            while len(self.records) > self.max_size:
+                self.records.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, username: str, notify: bool = True) -> None:
+        """
+        Drop the user's record after a change was committed, notify is False for changes of other processes.
+        """
+        with self.lock:
+            self.records.pop(username, None)
+            self.generation += 1
+
+        if notify:
+            for listener in self.listeners:
+                listener(username)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'size': len(self.records), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0}
@@ -1,39 +1,168 @@
 import hashlib
-import os
-import smtplib
+import queue
 import sqlite3
-from email.message import EmailMessage
-
-# Set your credentials here to send email
+import time
+from _thread import start_new_thread
+from concurrent.futures import Future
 from threading import Lock
 
-credentials = os.environ.get("EMAIL_ADDRESS"), os.environ.get("EMAIL_PASSWORD")
+from tracing import tracer
+
+
+class PerDatabase:
+    """
+    Base of the components a process keeps one of for every database, shared by all its request handlers.
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super(PerDatabase, cls).__init_subclass__(**kwargs)
+        # Every class has its own instances, creating one may create the instances of another class.
+        cls.instances = {}
+        cls.instances_lock = Lock()
+
+    @classmethod
+    def create(cls, path: str):
+        return cls(QueryExecutor.shared(path))
 
+    @classmethod
+    def shared(cls, path: str):
+        """
+        The instance of the database at path, created on first use.
+        """
+        with cls.instances_lock:
+            if path not in cls.instances:
+                cls.instances[path] = cls.create(path)
+            return cls.instances[path]
 
-def send_email(email: EmailMessage) -> None:
-    if credentials[0] is None or credentials[1] is None:
-        print(f"No email credentials are set, printing email:\n{email}")
-        return
 
-    try:
-        with smtplib.SMTP('smtp.gmail.com', port=587) as smtp_server:
-            smtp_server.ehlo()
-            smtp_server.starttls()
-            smtp_server.login(*credentials)
-            smtp_server.send_message(email)
-    except Exception as e:
-        print(f"Failed to send email, printing email:\n{email}\n\nERROR:")
-        raise e
+class QueryExecutor(PerDatabase):
+    """
+    SQLite access layer shared by all the request handlers of a process.
+    Reads run right away on a bounded pool of connections and never commit.
+    Writes are serialized by a single writer thread, which groups the writes that arrive within a short window
+    into one transaction, so that many handlers pay for a single commit.
+    The database is used in WAL mode so that readers never wait for the writer.
+    """
+    readers = 4
+    commit_window = 0.002  # Seconds the writer waits for more writes before committing.
+    max_group = 256  # Most writes committed together.
 
+    def __init__(self, path: str):
+        self.path = path
 
-class QueryExecutor:
-    def __init__(self, path):
-        self.db = sqlite3.connect(path)
+        self.read_pool = queue.Queue()
+        for _ in range(self.readers):
+            self.read_pool.put(self.connect())
+
+        self.writes = queue.Queue()
+        self.writer = self.connect()
+        self.writer.isolation_level = None  # Transactions are managed by write_loop.
+        start_new_thread(self.write_loop, ())
+
+        # Group commit metrics.
+        self.commits = 0
+        self.written = 0
+
+    @classmethod
+    def create(cls, path: str) -> "QueryExecutor":
+        return cls(path)
+
+    def connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA busy_timeout=5000")
+        return db
 
     def __call__(self, query: str, parameters: list) -> list:
-        result = list(self.db.execute(query, parameters))
-        self.db.commit()
-        return result
+        with tracer.span("db", query=query):
+            if is_read(query):
+                return self.read(query, parameters)
+            return self.submit(query, parameters).result()
+
+    def submit(self, query: str, parameters: list) -> Future:
+        """
+        Run the query without waiting for it, the future holds the resulting rows.
+        The future of a write is resolved only after its transaction was committed.
+        """
+        future = Future()
+        if is_read(query):
+            try:
+                future.set_result(self.read(query, parameters))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            self.writes.put((query, parameters, False, future))
+        return future
+
+    def submit_many(self, query: str, rows: list) -> Future:
+        """
+        Run a write once for every parameters in rows, as a single statement of the writer's group.
+        """
+        future = Future()
+        self.writes.put((query, rows, True, future))
+        return future
+
+    def read(self, query: str, parameters: list) -> list:
+        db = self.read_pool.get()
+        try:
+            return list(db.execute(query, parameters))
+        finally:
+            self.read_pool.put(db)
+
+    def write_loop(self) -> None:
+        while True:
+            group = [self.writes.get()]
+            deadline = time.monotonic() + self.commit_window
+            while len(group) < self.max_group:
+                try:
+                    group.append(self.writes.get_nowait())
+                    continue
+                except queue.Empty:
+                    pass
+
+                # A lone write is committed right away, the window only pays off when handlers write concurrently.
+                if len(group) == 1 or (timeout := deadline - time.monotonic()) <= 0:
+                    break
+                try:
+                    group.append(self.writes.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            self.write_group(group)
+
+    def write_group(self, group: list) -> None:
+        results = []
+        try:
+            self.writer.execute("BEGIN IMMEDIATE")
+            for query, parameters, many, future in group:
+                # A failing write is rolled back alone, the rest of the group is still committed.
+                self.writer.execute("SAVEPOINT write")
+                try:
+                    if many:
+                        results.append(self.writer.executemany(query, parameters).rowcount)
+                    else:
+                        results.append(list(self.writer.execute(query, parameters)))
+                except Exception as e:
+                    self.writer.execute("ROLLBACK TO write")
+                    results.append(e)
+                self.writer.execute("RELEASE write")
+            self.writer.execute("COMMIT")
+        except Exception as e:
+            if self.writer.in_transaction:
+                self.writer.execute("ROLLBACK")
+            results = [e] * len(group)
+
+        self.commits += 1
+        self.written += len(group)
+        for (_, _, _, future), result in zip(group, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def is_read(query: str) -> bool:
+    return query.lstrip()[:6].upper() == "SELECT"
 
 
 def encrypt(s: str) -> str: